@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""Benchmark of clang-format-validate.py on a synthetic tree of C++ sources.
+
+Generates a reproducible tree of headers and sources, formats it, breaks the
+formatting of a share of the files, then times the validator over the tree
+for every combination of job count, execution backend and cache state.
+The files per second and peak RSS of every run are written as JSON.
+
+Arguments after -- are passed to every validator run, e.g.:
+
+    clang-format-benchmark.py -j 1,4 --backends thread -- --batch-size 0
+"""
+
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+VALIDATOR = os.path.join(SCRIPT_DIR, 'clang-format-validate.py')
+STUB = os.path.join(SCRIPT_DIR, 'clang-format-stub.py')
+STYLE_FILE = os.path.join(SCRIPT_DIR, '..', '..', '.clang-format')
+FILES_PER_DIRECTORY = 50
+CACHE_STATES = ('off', 'cold', 'warm')
+
+
+def default_clang_format():
+    """The clang-format the validate_format_* scripts use on this platform."""
+    if sys.platform.startswith('win'):
+        name = 'clang-format_10.0.0.exe'
+    elif sys.platform == 'darwin':
+        name = 'clang-format_mac_10.0.0'
+    else:
+        name = 'clang-format_linux_10.0.0'
+    return os.path.join(SCRIPT_DIR, name)
+
+
+def make_function(rng, name):
+    lines = ['void {}(int Count, float* pValues)'.format(name), '{']
+    for i in range(rng.randint(1, 6)):
+        lines.extend([
+            '    for (int i = 0; i < Count; ++i)',
+            '    {',
+            '        if (pValues[i] > {}.f)'.format(rng.randint(1, 100)),
+            '            pValues[i] = pValues[i] * {}.f + {}.f;'.format(
+                rng.randint(1, 9), i),
+            '    }',
+        ])
+    lines.extend(['}', ''])
+    return lines
+
+
+def make_struct(rng, name):
+    lines = ['struct {}'.format(name), '{']
+    for i in range(rng.randint(2, 10)):
+        lines.append('    {} Member{} = {{}};'.format(
+            rng.choice(('int', 'float', 'Uint32', 'const char*')), i))
+    lines.extend(['};', ''])
+    return lines
+
+
+def make_file(rng, name, size, header):
+    """C++ file of about size bytes, close to the repo's formatting."""
+    lines = []
+    if header:
+        lines.extend(['#pragma once', ''])
+    else:
+        lines.extend(['#include "{}.hpp"'.format(name), ''])
+    lines.extend(['namespace Diligent', '{', ''])
+    length = 0
+    index = 0
+    while length < size:
+        if header:
+            block = make_struct(rng, '{}Desc{}'.format(name, index))
+        else:
+            block = make_function(rng, '{}Update{}'.format(name, index))
+        lines.extend(block)
+        length += sum(len(line) + 1 for line in block)
+        index += 1
+    lines.extend(['} // namespace Diligent', ''])
+    return '\n'.join(lines)
+
+
+def generate_corpus(root, nfiles, mean_size, seed):
+    """Writes nfiles headers and sources to root, returns their paths.
+
+    File sizes follow a log-normal distribution of the given mean, so that a
+    few large files dominate like in a real tree.
+    """
+    rng = random.Random(seed)
+    sigma = 1.0
+    mu = math.log(mean_size) - sigma * sigma / 2
+    paths = []
+    for i in range(nfiles):
+        module = 'Module{}'.format(i // FILES_PER_DIRECTORY)
+        header = i % 2 == 0
+        directory = os.path.join(root, module,
+                                 'include' if header else 'src')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = 'File{}'.format(i // 2)
+        path = os.path.join(directory,
+                            name + ('.hpp' if header else '.cpp'))
+        size = int(rng.lognormvariate(mu, sigma))
+        with io.open(path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(make_file(rng, name, size, header))
+        paths.append(path)
+    if os.path.isfile(STYLE_FILE):
+        shutil.copy(STYLE_FILE, os.path.join(root, '.clang-format'))
+    return paths
+
+
+def break_formatting(paths, rate, seed):
+    """Adds trailing whitespace to a few lines of rate * len(paths) files,
+    returns the number of files changed.
+    """
+    rng = random.Random(seed)
+    broken = rng.sample(paths, int(round(rate * len(paths))))
+    for path in broken:
+        with io.open(path, 'r', encoding='utf-8', newline='') as f:
+            lines = f.read().split('\n')
+        for _ in range(rng.randint(1, 3)):
+            i = rng.randrange(len(lines) - 1)
+            lines[i] += '   '
+        with io.open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write('\n'.join(lines))
+    return len(broken)
+
+
+def backdate(root, seconds):
+    """Sets the mtime of every file under root seconds in the past.
+
+    The validator does not trust the stat of files modified within its
+    mtime granularity to skip them, the warm runs would hit its inventory
+    or not depending on how long the setup took otherwise.
+    """
+    when = time.time() - seconds
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            os.utime(os.path.join(dirpath, filename), (when, when))
+
+
+def run_validator(arguments):
+    """Runs the validator, returns its exit code, wall time and peak RSS in
+    bytes (None where it cannot be measured).
+
+    Raises RuntimeError if the validator fails for another reason than
+    formatting violations.
+    """
+    invocation = [sys.executable, VALIDATOR] + arguments
+    with tempfile.TemporaryFile() as errs:
+        start = time.time()
+        proc = subprocess.Popen(invocation, stdout=subprocess.DEVNULL,
+                                stderr=errs)
+        if hasattr(os, 'wait4'):
+            # the rusage of the child includes the clang-format processes
+            # it waited for, ru_maxrss is the largest of them all
+            _, status, rusage = os.wait4(proc.pid, 0)
+            seconds = time.time() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = rusage.ru_maxrss
+            if sys.platform != 'darwin':
+                # kilobytes everywhere but on macOS
+                peak_rss *= 1024
+        else:
+            proc.wait()
+            seconds = time.time() - start
+            peak_rss = None
+        if proc.returncode not in (0, 1):
+            errs.seek(0)
+            raise RuntimeError('{} failed with exit code {}:\n{}'.format(
+                subprocess.list2cmdline(invocation), proc.returncode,
+                errs.read().decode('utf-8', 'replace')))
+    return proc.returncode, seconds, peak_rss
+
+
+def benchmark(args, root, nfiles, jobs, backend, cache):
+    cache_dir = tempfile.mkdtemp(prefix='clang-format-benchmark-cache')
+    try:
+        arguments = [
+            '--clang-format-executable', args.clang_format_executable,
+            '-r', root, '-j', str(jobs), '--backend', backend,
+            '--cache-dir', cache_dir
+        ] + args.validator_args
+        if cache == 'off':
+            arguments.append('--no-cache')
+        times = []
+        peak_rss = None
+        for _ in range(args.repeat):
+            if cache == 'warm' and not times:
+                run_validator(arguments)
+            elif cache == 'cold':
+                shutil.rmtree(cache_dir)
+                os.mkdir(cache_dir)
+            exit_code, seconds, rss = run_validator(arguments)
+            times.append(seconds)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    best = min(times)
+    return {
+        'jobs': jobs,
+        'backend': backend,
+        'cache': cache,
+        'exit_code': exit_code,
+        'seconds': best,
+        'times': times,
+        'files_per_second': nfiles / best,
+        'peak_rss': peak_rss,
+    }
+
+
+def split_list(value):
+    return [item for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--clang-format-executable',
+        metavar='EXECUTABLE',
+        default=default_clang_format(),
+        help='path to the clang-format executable'
+        ' (default: the bundled one)')
+    parser.add_argument(
+        '--stub',
+        action='store_true',
+        help='use clang-format-stub.py as the clang-format executable, to'
+        ' measure the overhead of the validator itself; it is configured'
+        ' with the CLANG_FORMAT_STUB_* environment variables')
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=1000,
+        help='number of files in the tree, half headers and half sources'
+        ' (default: %(default)s)')
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=8000,
+        help='mean file size in bytes (default: %(default)s)')
+    parser.add_argument(
+        '--violations',
+        type=float,
+        default=0.05,
+        help='share of the files with formatting violations'
+        ' (default: %(default)s)')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='seed of the generated tree (default: %(default)s)')
+    parser.add_argument(
+        '-j',
+        metavar='N,...',
+        default='1,{}'.format(multiprocessing.cpu_count() + 1),
+        help='comma-separated job counts to run with, 0 for the validator'
+        ' default (default: %(default)s)')
+    parser.add_argument(
+        '--backends',
+        metavar='NAME,...',
+        default='process,thread,asyncio',
+        help='comma-separated execution backends to run with'
+        ' (default: %(default)s)')
+    parser.add_argument(
+        '--cache',
+        metavar='STATE,...',
+        default=','.join(CACHE_STATES),
+        help='comma-separated result cache states to run with: off'
+        ' (--no-cache), cold (empty cache) and warm (filled by a previous'
+        ' run) (default: %(default)s)')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='runs per combination, the fastest one is reported'
+        ' (default: %(default)s)')
+    parser.add_argument(
+        '--tree',
+        metavar='DIR',
+        help='generate the tree in DIR and keep it,'
+        ' instead of a temporary directory')
+    parser.add_argument(
+        '--output',
+        metavar='PATH',
+        help='write the results to PATH instead of stdout')
+    parser.add_argument(
+        'validator_args',
+        nargs=argparse.REMAINDER,
+        help='arguments passed to every validator run, after --')
+
+    args = parser.parse_args()
+    if args.stub:
+        args.clang_format_executable = STUB
+    if args.validator_args[:1] == ['--']:
+        args.validator_args = args.validator_args[1:]
+    cache_states = split_list(args.cache)
+    for state in cache_states:
+        if state not in CACHE_STATES:
+            parser.error('unknown cache state: {}'.format(state))
+
+    root = args.tree or tempfile.mkdtemp(prefix='clang-format-benchmark')
+    try:
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        paths = generate_corpus(root, args.files, args.size, args.seed)
+        # let the formatter settle the generated code, so that only the
+        # broken files have violations whatever its style
+        run_validator([
+            '--clang-format-executable', args.clang_format_executable, '-r',
+            root, '--fix', '--no-cache', '--quiet'
+        ])
+        violations = break_formatting(paths, args.violations, args.seed)
+        backdate(root, 60)
+        report = {
+            'corpus': {
+                'files': len(paths),
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'violations': violations,
+                'seed': args.seed,
+            },
+            'clang_format_executable': args.clang_format_executable,
+            'clang_format_version': subprocess.check_output(
+                [args.clang_format_executable,
+                 '--version']).decode('utf-8', 'replace').strip(),
+            'validator_args': args.validator_args,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'runs': [],
+        }
+        for jobs in split_list(args.j):
+            for backend in split_list(args.backends):
+                for cache in cache_states:
+                    run = benchmark(args, root, len(paths), int(jobs),
+                                    backend, cache)
+                    print('-j {} {} cache {}: {:.1f} files/s'.format(
+                        jobs, backend, cache, run['files_per_second']),
+                          file=sys.stderr)
+                    report['runs'].append(run)
+    except RuntimeError as e:
+        print('{}: {}'.format(parser.prog, e), file=sys.stderr)
+        return 2
+    finally:
+        if not args.tree:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""A deterministic stand-in for clang-format, for testing and benchmarking
+clang-format-validate.py without the bundled binaries:
+
+    clang-format-validate.py --clang-format-executable clang-format-stub.py
+
+It understands the subset of the clang-format command line the validator
+uses: --version, --lines, --output-replacements-xml, --assume-filename,
+files or stdin. Instead of a style, it applies simple line rules. Its
+behaviour is configured with environment variables:
+
+    CLANG_FORMAT_STUB_RULES         comma-separated rules to apply
+                                    (default: all of them)
+                                    trailing-whitespace: strip it
+                                    tabs: expand leading tabs to 4 spaces
+                                    final-newline: end files with a newline
+    CLANG_FORMAT_STUB_LATENCY       milliseconds every run sleeps
+    CLANG_FORMAT_STUB_BYTE_LATENCY  additional milliseconds per KiB of input
+    CLANG_FORMAT_STUB_FAIL          fnmatch pattern of the file names to fail
+                                    on, like clang-format on invalid input
+
+The configuration shows in --version, so that the result cache of the
+validator tells the configurations apart.
+"""
+
+import fnmatch
+import os
+import re
+import sys
+import time
+
+VERSION = '10.0.0'
+RULES = ('trailing-whitespace', 'tabs', 'final-newline')
+
+
+class Config(object):
+    def __init__(self, environ):
+        rules = environ.get('CLANG_FORMAT_STUB_RULES')
+        self.rules = RULES if rules is None else tuple(
+            rule for rule in rules.split(',') if rule)
+        for rule in self.rules:
+            if rule not in RULES:
+                raise ValueError('unknown rule: {}'.format(rule))
+        self.latency = float(environ.get('CLANG_FORMAT_STUB_LATENCY', 0))
+        self.byte_latency = float(
+            environ.get('CLANG_FORMAT_STUB_BYTE_LATENCY', 0))
+        self.fail = environ.get('CLANG_FORMAT_STUB_FAIL')
+
+    def describe(self):
+        return 'rules={} latency={} byte-latency={}'.format(
+            ','.join(self.rules), self.latency, self.byte_latency)
+
+
+def format_line(line, rules):
+    """Applies the rules to a line without its line terminator."""
+    if 'tabs' in rules:
+        indent = len(line) - len(line.lstrip(b'\t'))
+        if indent:
+            line = b'    ' * indent + line[indent:]
+    if 'trailing-whitespace' in rules:
+        line = line.rstrip(b' \t')
+    return line
+
+
+def replacements(data, rules, ranges):
+    """Edits of data as (offset, length, text) tuples, for the lines within
+    ranges (1-based, inclusive), or all of them if there are none.
+    """
+    edits = []
+    offset = 0
+    lines = data.split(b'\n')
+    for number, line in enumerate(lines, 1):
+        selected = not ranges or any(first <= number <= last
+                                     for first, last in ranges)
+        body = line[:-1] if line.endswith(b'\r') else line
+        if selected:
+            formatted = format_line(body, rules)
+            if formatted != body:
+                edits.append((offset, len(body), formatted))
+        offset += len(line) + 1
+    if ('final-newline' in rules and data and not data.endswith(b'\n')
+            and (not ranges or any(last >= len(lines) for _, last in ranges))):
+        edits.append((len(data), 0, b'\n'))
+    return edits
+
+
+def apply(data, edits):
+    chunks = []
+    end = 0
+    for offset, length, text in edits:
+        chunks.append(data[end:offset])
+        chunks.append(text)
+        end = offset + length
+    chunks.append(data[end:])
+    return b''.join(chunks)
+
+
+def escape(text):
+    text = text.decode('utf-8', 'replace')
+    for char, entity in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'),
+                         ('\r', '&#13;'), ('\n', '&#10;')):
+        text = text.replace(char, entity)
+    return text
+
+
+def replacements_xml(edits):
+    out = [
+        "<?xml version='1.0'?>\n"
+        "<replacements xml:space='preserve' incomplete_format='false'>\n"
+    ]
+    for offset, length, text in edits:
+        out.append("<replacement offset='{}' length='{}'>{}</replacement>\n"
+                   .format(offset, length, escape(text)))
+    out.append('</replacements>\n')
+    return ''.join(out).encode('utf-8')
+
+
+def main(argv):
+    try:
+        config = Config(os.environ)
+    except ValueError as e:
+        sys.stderr.write('error: {}\n'.format(e))
+        return 1
+    ranges = []
+    xml = False
+    assume_filename = '<stdin>'
+    files = []
+    for arg in argv:
+        if arg == '--version':
+            print('clang-format version {} (stub: {})'.format(
+                VERSION, config.describe()))
+            return 0
+        match = re.match(r'--lines=(\d+):(\d+)$', arg)
+        if match:
+            ranges.append((int(match.group(1)), int(match.group(2))))
+        elif arg == '--output-replacements-xml':
+            xml = True
+        elif arg.startswith('--assume-filename='):
+            assume_filename = arg[len('--assume-filename='):]
+        elif arg.startswith('--style=') or arg.startswith('--fallback-style='):
+            pass
+        elif arg.startswith('-'):
+            sys.stderr.write('error: unknown argument: {}\n'.format(arg))
+            return 1
+        else:
+            files.append(arg)
+    if ranges and len(files) > 1:
+        sys.stderr.write('error: -lines can only be used for one file.\n')
+        return 1
+
+    if files:
+        inputs = []
+        for file in files:
+            try:
+                with open(file, 'rb') as f:
+                    inputs.append((file, f.read()))
+            except EnvironmentError as e:
+                sys.stderr.write('error: {}\n'.format(e))
+                return 1
+    else:
+        inputs = [(assume_filename, sys.stdin.buffer.read())]
+
+    time.sleep((config.latency + config.byte_latency *
+                sum(len(data) for _, data in inputs) / 1024.0) / 1000.0)
+
+    out = sys.stdout.buffer
+    for name, data in inputs:
+        if config.fail and fnmatch.fnmatch(name, config.fail):
+            sys.stderr.write('{}:1:1: error: stub failure\n'.format(name))
+            return 1
+        edits = replacements(data, config.rules, ranges)
+        if xml:
+            out.write(replacements_xml(edits))
+        else:
+            out.write(apply(data, edits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """A wrapper script around clang-format, suitable for linting multiple files
 and to use for continuous integration.
 This is an alternative API for the clang-format command line.
@@ -6,31 +6,52 @@ It runs over multiple files and directories in parallel.
 A diff output is produced and a sensible exit code is returned.
 """
 
-from __future__ import print_function, unicode_literals
-
 import argparse
-import codecs
+import asyncio
 import difflib
 import fnmatch
 import io
 import errno
+import hashlib
+import json
+import mmap
 import multiprocessing
 import os
+import re
+import select
+import shutil
 import signal
+import socket
+import socketserver
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
-
-try:
-    from subprocess import DEVNULL  # py3k
-except ImportError:
-    DEVNULL = open(os.devnull, "wb")
+from xml.etree import ElementTree
 
 
 DEFAULT_EXTENSIONS = 'c,h,C,H,cpp,hpp,cc,hh,c++,h++,cxx,hxx'
 DEFAULT_CLANG_FORMAT_IGNORE = '.clang-format-ignore'
+DEFAULT_CACHE_SIZE = 50000
+SCHEDULES = ('walk', 'largest', 'recent', 'history')
+MAX_BATCH_SIZE = 64
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+# seconds between the result cache evictions of --serve
+EVICT_INTERVAL = 60
+# memory a clang-format job is assumed to need, caps the default -j
+# under a cgroup memory limit
+MEMORY_PER_JOB = 256 * 1024 * 1024
+CGROUP_ROOT = '/sys/fs/cgroup'
+# stages of FileResult.timings, in the order they happen
+FILE_STAGES = ('read', 'spawn', 'format', 'decode', 'diff')
+STYLE_FILE_NAMES = ('.clang-format', '_clang-format')
 
 
 class ExitStatus:
@@ -56,52 +77,776 @@ def excludes_from_file(ignore_file):
             raise
     return excludes;
 
+class ExcludeMatcher(object):
+    """Glob-like exclude patterns compiled into a single regular expression.
+
+    Matches like fnmatch.fnmatch() against any of the patterns. A pattern
+    ending in '/*' also excludes the directory before it as a whole,
+    since '*' matches path separators and everything below it would be
+    excluded anyway, which lets list_files() prune the directory without
+    listing it.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        self._files = self._compile(self.patterns)
+        self._trees = self._compile(
+            p[:-2] for p in self.patterns
+            if p.endswith('/*') or p.endswith(os.sep + '*'))
+
+    @staticmethod
+    def _compile(patterns):
+        regexes = [
+            fnmatch.translate(os.path.normcase(p)) for p in patterns
+        ]
+        if not regexes:
+            return None
+        return re.compile('|'.join('(?:{})'.format(r) for r in regexes))
+
+    def extend(self, patterns):
+        """A new matcher with the given patterns added."""
+        if not patterns:
+            return self
+        return ExcludeMatcher(self.patterns + list(patterns))
+
+    def match(self, path):
+        return bool(self._files
+                    and self._files.match(os.path.normcase(path)))
+
+    def prune(self, dirpath):
+        """Whether nothing below dirpath can be selected."""
+        path = os.path.normcase(dirpath)
+        return bool((self._files and self._files.match(path))
+                    or (self._trees and self._trees.match(path)))
+
+    def for_directory(self, dirpath, has_ignore_file=None):
+        """The matcher for the contents of dirpath, with the patterns of its
+        .clang-format-ignore added, which are relative to dirpath.
+        """
+        if has_ignore_file is None:
+            has_ignore_file = os.path.isfile(
+                os.path.join(dirpath, DEFAULT_CLANG_FORMAT_IGNORE))
+        if not has_ignore_file:
+            return self
+        return self.extend(
+            os.path.join(dirpath, p.lstrip('/')) for p in excludes_from_file(
+                os.path.join(dirpath, DEFAULT_CLANG_FORMAT_IGNORE)))
+
+
 def list_files(files, recursive=False, extensions=None, exclude=None):
     if extensions is None:
         extensions = []
-    if exclude is None:
-        exclude = []
+    if not isinstance(exclude, ExcludeMatcher):
+        exclude = ExcludeMatcher(exclude or [])
+    extensions = frozenset(extensions)
 
     out = []
     for file in files:
         if recursive and os.path.isdir(file):
-            for dirpath, dnames, fnames in os.walk(file):
-                fpaths = [os.path.join(dirpath, fname) for fname in fnames]
-                for pattern in exclude:
-                    # os.walk() supports trimming down the dnames list
-                    # by modifying it in-place,
-                    # to avoid unnecessary directory listings.
-                    dnames[:] = [
-                        x for x in dnames
-                        if
-                        not fnmatch.fnmatch(os.path.join(dirpath, x), pattern)
-                    ]
-                    fpaths = [
-                        x for x in fpaths if not fnmatch.fnmatch(x, pattern)
-                    ]
-                for f in fpaths:
-                    ext = os.path.splitext(f)[1][1:]
-                    if ext in extensions:
-                        out.append(f)
+            _walk(file, exclude, extensions, out)
         else:
             out.append(file)
     return out
 
 
-def make_diff(file, original, reformatted):
-    return list(
-        difflib.unified_diff(
-            original,
-            reformatted,
-            fromfile='{}\t(original)'.format(file),
-            tofile='{}\t(reformatted)'.format(file),
-            n=3))
+def _walk(top, exclude, extensions, out):
+    # Same order as os.walk(): the files of a directory come before the
+    # files of its subdirectories, which are visited in listing order.
+    stack = [(top, exclude)]
+    while stack:
+        dirpath, exclude = stack.pop()
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            # os.walk() skips unreadable directories too
+            continue
+        exclude = exclude.for_directory(
+            dirpath,
+            any(e.name == DEFAULT_CLANG_FORMAT_IGNORE for e in entries))
+        subdirs = []
+        for entry in entries:
+            path = os.path.join(dirpath, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # like os.walk(), do not follow symbolic links to directories
+                if not entry.is_symlink() and not exclude.prune(path):
+                    subdirs.append(path)
+                continue
+            ext = os.path.splitext(entry.name)[1][1:]
+            if ext in extensions and not exclude.match(path):
+                out.append(path)
+        stack.extend((d, exclude) for d in reversed(subdirs))
+
+
+def unique_real_paths(files):
+    """files without those resolving to the same real path as an earlier
+    one, through symbolic links, so that --fix writes each file once.
+    """
+    seen = set()
+    out = []
+    for file in files:
+        path = os.path.realpath(file)
+        if path not in seen:
+            seen.add(path)
+            out.append(file)
+    return out
+
+
+def is_excluded(path, root, exclude):
+    """Whether list_files() would skip path when walking root.
+
+    Checks every directory between root and path like list_files() does,
+    including the .clang-format-ignore files found in them.
+    """
+    parents = []
+    parent = os.path.dirname(path)
+    while len(parent) > len(root) and parent != os.path.dirname(parent):
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    exclude = exclude.for_directory(root)
+    for parent in reversed(parents):
+        if exclude.prune(parent):
+            return True
+        exclude = exclude.for_directory(parent)
+    return exclude.match(path)
+
+
+def git_output(args):
+    return subprocess.check_output(['git'] + args).decode('utf-8')
+
+
+def list_changed_files(files,
+                       since=None,
+                       staged=False,
+                       recursive=False,
+                       extensions=None,
+                       exclude=None):
+    """Same selection as list_files(), restricted to the files git reports
+    as added, copied, modified or renamed.
+
+    With since, changes are taken relative to that commit, with staged from
+    the index, and with both from the index relative to that commit.
+    """
+    if extensions is None:
+        extensions = []
+    if not isinstance(exclude, ExcludeMatcher):
+        exclude = ExcludeMatcher(exclude or [])
+
+    toplevel = git_output(['rev-parse', '--show-toplevel']).strip()
+    invocation = ['diff', '--name-only', '--diff-filter=ACMR', '-z']
+    if staged:
+        invocation.append('--cached')
+    if since:
+        invocation.append(since)
+    invocation.append('--')
+    changed = [
+        os.path.realpath(os.path.join(toplevel, name))
+        for name in git_output(invocation).split('\0') if name
+    ]
+    return select_paths(changed, files, recursive, extensions, exclude)
+
+
+def select_paths(paths, files, recursive, extensions, exclude):
+    """The real paths list_files() would have selected from files, named
+    as list_files() would.
+    """
+    roots = [(root, os.path.realpath(root)) for root in files]
+    out = []
+    for path in paths:
+        for root, real_root in roots:
+            if path == real_root:
+                # explicitly listed files are not filtered, as in list_files()
+                out.append(root)
+                break
+            if not recursive or not path.startswith(real_root + os.sep):
+                continue
+            candidate = os.path.join(root, os.path.relpath(path, real_root))
+            ext = os.path.splitext(candidate)[1][1:]
+            if ext in extensions and not is_excluded(candidate, root,
+                                                      exclude):
+                out.append(candidate)
+            break
+    return out
+
+
+def changed_line_ranges(since=None, staged=False):
+    """Line ranges touched by the changes list_changed_files() selects.
+
+    Returns a dict mapping the real path of every changed file to a list of
+    (first, last) 1-based inclusive line ranges in its new version.
+    """
+    toplevel = git_output(['rev-parse', '--show-toplevel']).strip()
+    invocation = [
+        '-c', 'core.quotePath=false', 'diff', '--no-color', '--no-ext-diff',
+        '--unified=0', '--diff-filter=ACMR', '--src-prefix=a/',
+        '--dst-prefix=b/'
+    ]
+    if staged:
+        invocation.append('--cached')
+    if since:
+        invocation.append(since)
+    invocation.append('--')
+
+    ranges = {}
+    current = None
+    for line in git_output(invocation).splitlines():
+        if line.startswith('+++ '):
+            # names with spaces are followed by a tab
+            name = line[4:].rstrip('\t')
+            if name.startswith('b/'):
+                current = ranges.setdefault(
+                    os.path.realpath(os.path.join(toplevel, name[2:])), [])
+            else:
+                current = None
+        elif line.startswith('@@ ') and current is not None:
+            # @@ -start[,count] +start[,count] @@
+            new = line.split(' ')[2][1:].split(',')
+            start = int(new[0])
+            count = int(new[1]) if len(new) > 1 else 1
+            if count:
+                current.append((start, start + count - 1))
+            elif start:
+                # pure deletion, check the line that now joins the gap
+                current.append((start, start))
+    return ranges
+
+
+def read_index_blobs(files):
+    """Reads the contents of files staged in the git index with a single
+    git cat-file process.
+
+    Returns a dict mapping the real path of every file to its staged
+    contents, files missing from the index are left out.
+    """
+    toplevel = os.path.realpath(
+        git_output(['rev-parse', '--show-toplevel']).strip())
+    paths = []
+    names = []
+    for file in files:
+        path = os.path.realpath(file)
+        name = os.path.relpath(path, toplevel).replace(os.sep, '/')
+        if '\n' in name or name.startswith('../'):
+            continue
+        paths.append(path)
+        # :<path> is the stage 0 blob of path in the index
+        names.append(':' + name + '\n')
+    proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    outs, _ = proc.communicate(''.join(names).encode('utf-8'))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode,
+                                            'git cat-file --batch')
+
+    blobs = {}
+    pos = 0
+    for path in paths:
+        # "<oid> blob <size>\n<contents>\n" or "<name> missing\n"
+        end = outs.index(b'\n', pos)
+        header = outs[pos:end].split(b' ')
+        pos = end + 1
+        if header[-1] == b'missing' or len(header) != 3:
+            continue
+        size = int(header[2])
+        blobs[path] = outs[pos:pos + size]
+        pos += size + 1
+    return blobs
+
+
+def _format_range(start, stop):
+    # same as the private difflib._format_range_unified()
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+
+def make_diff(file, original, reformatted, n=3):
+    """Unified diff of two line lists, in the format of
+    difflib.unified_diff().
+
+    The common leading and trailing lines are stripped before running the
+    sequence matcher, so the cost follows the size of the changed region
+    rather than the size of the file. The matcher may then align the
+    changed lines differently than difflib.unified_diff() would, the diff
+    is just as valid.
+    """
+    limit = min(len(original), len(reformatted))
+    prefix = 0
+    while prefix < limit and original[prefix] == reformatted[prefix]:
+        prefix += 1
+    if prefix == len(original) == len(reformatted):
+        return []
+    suffix = 0
+    while (suffix < limit - prefix
+           and original[-1 - suffix] == reformatted[-1 - suffix]):
+        suffix += 1
+    a_end = len(original) - suffix
+    b_end = len(reformatted) - suffix
+
+    matcher = difflib.SequenceMatcher(None, original[prefix:a_end],
+                                      reformatted[prefix:b_end])
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix,
+                        j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', a_end, len(original), b_end,
+                        len(reformatted)))
+    return format_unified_diff(file, opcodes, original, reformatted, n)
+
+
+def group_opcodes(opcodes, n=3):
+    """Groups the opcodes of whole files into hunks with up to n lines of
+    context, like difflib.SequenceMatcher.get_grouped_opcodes().
+    """
+    codes = list(opcodes)
+    if not codes:
+        return []
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # split the hunks at equal runs longer than their two contexts
+        if tag == 'equal' and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def format_unified_diff(file, opcodes, original, reformatted, n=3):
+    """Formats opcodes covering the whole files the way
+    difflib.unified_diff() does, with n lines of context.
+
+    original and reformatted only need to be indexable by line number,
+    for the lines of the hunks.
+    """
+    diff = [
+        '--- {}\t(original)\n'.format(file),
+        '+++ {}\t(reformatted)\n'.format(file),
+    ]
+    for group in group_opcodes(opcodes, n):
+        first, last = group[0], group[-1]
+        diff.append('@@ -{} +{} @@\n'.format(
+            _format_range(first[1], last[2]), _format_range(first[3],
+                                                             last[4])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                diff.extend(' ' + original[i] for i in range(i1, i2))
+                continue
+            if tag in ('replace', 'delete'):
+                diff.extend('-' + original[i] for i in range(i1, i2))
+            if tag in ('replace', 'insert'):
+                diff.extend('+' + reformatted[j] for j in range(j1, j2))
+    return diff
+
+
+def split_lines(data):
+    """Decodes raw file contents into lines,
+    with the same newline translation as reading the file in text mode.
+    """
+    return io.StringIO(data.decode('utf-8'), newline=None).readlines()
+
+
+def make_replacements_diff(file, content, replacements, n=3):
+    """Unified diff of the changes a clang-format <replacements> element
+    makes to the raw file contents.
+
+    Only the lines around the replaced offsets are decoded and compared,
+    a file without effective replacements costs nothing at all.
+    """
+    edits = []
+    for r in replacements.findall('replacement'):
+        offset = int(r.get('offset'))
+        length = int(r.get('length'))
+        text = (r.text or '').encode('utf-8')
+        if content[offset:offset + length] != text:
+            edits.append((offset, length, text))
+    if not edits:
+        return []
+    if content.count(b'\r') != content.count(b'\r\n'):
+        # lone carriage returns also end lines in text mode,
+        # leave these rare files to the full diff
+        return make_diff(file, split_lines(content),
+                         split_lines(apply_replacements(content,
+                                                        replacements)), n)
+    edits.sort(key=lambda edit: edit[0])
+
+    # widen the edits to whole lines, merging the ones on shared or
+    # adjacent lines
+    regions = []
+    for offset, length, text in edits:
+        start = content.rfind(b'\n', 0, offset) + 1
+        end = content.find(b'\n', offset + length)
+        end = len(content) if end < 0 else end + 1
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+            regions[-1][2].append((offset, length, text))
+        else:
+            regions.append([start, end, [(offset, length, text)]])
+
+    # sparse line tables, only filled around the regions,
+    # which is all the context format_unified_diff() asks for
+    original = {}
+    reformatted = {}
+    opcodes = []
+    line = 0
+    counted = 0
+    delta = 0
+    for start, end, region_edits in regions:
+        line += content.count(b'\n', counted, start)
+        counted = end
+        new = []
+        pos = start
+        for offset, length, text in region_edits:
+            new.append(content[pos:offset])
+            new.append(text)
+            pos = offset + length
+        new.append(content[pos:end])
+        old_lines = split_lines(content[start:end])
+        new_lines = split_lines(b''.join(new))
+
+        i1 = line
+        j1 = line + delta
+        for k, text in enumerate(old_lines):
+            original[i1 + k] = text
+        for k, text in enumerate(new_lines):
+            reformatted[j1 + k] = text
+        pos = start
+        for k in range(1, n + 1):
+            if i1 - k < 0 or i1 - k in original:
+                break
+            prev = content.rfind(b'\n', 0, pos - 1) + 1
+            original[i1 - k] = split_lines(content[prev:pos])[0]
+            pos = prev
+        pos = end
+        for k in range(n):
+            if pos >= len(content):
+                break
+            nxt = content.find(b'\n', pos)
+            nxt = len(content) if nxt < 0 else nxt + 1
+            original[i1 + len(old_lines) + k] = split_lines(
+                content[pos:nxt])[0]
+            pos = nxt
+
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+        for tag, a1, a2, b1, b2 in matcher.get_opcodes():
+            opcodes.append((tag, i1 + a1, i1 + a2, j1 + b1, j1 + b2))
+        line += len(old_lines)
+        delta += len(new_lines) - len(old_lines)
+    if all(op[0] == 'equal' for op in opcodes):
+        # only newline styles changed, invisible in text mode
+        return []
+
+    total = content.count(b'\n')
+    if content and not content.endswith(b'\n'):
+        total += 1
+
+    # fill the gaps between the regions, merging adjacent equal runs
+    # so the context trimming of group_opcodes() applies to them
+    merged = []
+    a_end = b_end = 0
+    for op in opcodes + [('equal', total, total, total + delta,
+                          total + delta)]:
+        if op[1] > a_end:
+            merged.append(['equal', a_end, op[1], b_end, op[3]])
+        if op[0] == 'equal' and merged and merged[-1][0] == 'equal':
+            merged[-1][2] = op[2]
+            merged[-1][4] = op[4]
+        elif op[1] < op[2] or op[3] < op[4]:
+            merged.append(list(op))
+        a_end = op[2]
+        b_end = op[4]
+    return format_unified_diff(file, [tuple(op) for op in merged], original,
+                               reformatted, n)
+
+
+def default_cache_dir():
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'clang-format-validate')
+
+
+def bundled_clang_format():
+    """The clang-format shipped next to this script for this platform."""
+    if sys.platform.startswith('win'):
+        name = 'clang-format_10.0.0.exe'
+    elif sys.platform == 'darwin':
+        name = 'clang-format_mac_10.0.0'
+    else:
+        name = 'clang-format_linux_10.0.0'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def version_number(text):
+    """The x.y.z version number in text, None if there is none."""
+    match = re.search(r'\d+\.\d+\.\d+', text)
+    return match.group(0) if match else None
+
+
+def probe_clang_format(executable, quiet=False):
+    """The --version output of executable.
+
+    Raises subprocess.CalledProcessError or OSError if it cannot run.
+    """
+    return subprocess.check_output(
+        [executable, '--version'],
+        stderr=subprocess.DEVNULL if quiet else None).decode(
+            'utf-8', 'replace').strip()
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def resolve_clang_format(executable, cache_dir, warn):
+    """The path and --version output of the clang-format to use.
+
+    An explicit executable is looked up in PATH and probed on every run,
+    raising like probe_clang_format() if it fails: its version may depend
+    on more than the executable itself, e.g. the environment of a wrapper
+    script. Without one, the bundled clang-format is used if it runs,
+    otherwise a system clang-format, preferably of the same version;
+    (None, None) is returned when there is none. warn is called with the
+    lines of a warning when falling back.
+
+    The outcome of that search is kept in cache_dir, if given, until PATH
+    or the size or mtime of the bundled or chosen executable changes, so
+    that repeated runs do not start any of them. forget_clang_format()
+    drops it when the executable stops running for another reason, like
+    a missing shared library.
+    """
+    if executable:
+        resolved = shutil.which(executable) or executable
+        return resolved, probe_clang_format(resolved)
+
+    path = os.path.join(cache_dir, 'executables.json') if cache_dir else None
+    search_path = os.environ.get('PATH', '')
+    if path:
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['search_path'] == search_path and all(
+                    file_stamp(stamped) == stamp
+                    for stamped, stamp in entry['stamps'].items()):
+                return entry['path'], entry['version']
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            pass
+
+    bundled = bundled_clang_format()
+    stamped = [bundled]
+    try:
+        resolved = bundled
+        version = probe_clang_format(bundled, quiet=True)
+    except (subprocess.CalledProcessError, OSError):
+        resolved, version = find_system_clang_format(
+            version_number(os.path.basename(bundled)), warn)
+        if resolved is None:
+            return None, None
+        stamped.append(resolved)
+
+    if path:
+        try:
+            entry = {
+                'path': resolved,
+                'version': version,
+                'search_path': search_path,
+                'stamps': dict((p, file_stamp(p)) for p in stamped),
+            }
+            write_file_atomic(path, json.dumps(entry).encode('utf-8'))
+        except EnvironmentError:
+            # like the result cache, never fail validation over it
+            pass
+    return resolved, version
+
+
+def forget_clang_format(cache_dir):
+    """Drops the executable kept in cache_dir by resolve_clang_format()."""
+    try:
+        os.remove(os.path.join(cache_dir, 'executables.json'))
+    except EnvironmentError:
+        pass
+
+
+def find_system_clang_format(wanted, warn):
+    """A clang-format from PATH, of version wanted if there is one."""
+    names = ['clang-format']
+    if wanted:
+        # e.g. clang-format-10 next to other versions on Debian
+        names.insert(0, 'clang-format-' + wanted.split('.')[0])
+    found = None
+    for name in names:
+        candidate = shutil.which(name)
+        if not candidate:
+            continue
+        try:
+            version = probe_clang_format(candidate, quiet=True)
+        except (subprocess.CalledProcessError, OSError):
+            continue
+        if version_number(version) == wanted:
+            return candidate, version
+        if found is None:
+            found = candidate, version
+    if found is None:
+        return None, None
+    warn([
+        'could not load the provided clang-format for validation.',
+        '   clang-format exists in the system path however its version is'
+        ' {} instead of {}'.format(version_number(found[1]), wanted),
+        '   Should the validation fail, you can try skipping it by setting'
+        ' the cmake option:',
+        '   DILIGENT_NO_FORMAT_VALIDATION',
+    ])
+    return found
+
+
+class StyleResolver(object):
+    """Finds the .clang-format that applies to files, with the upward search
+    clang-format does with -style=file, once per directory.
+
+    A run carries its resolver as args.styles, pool workers fill their own
+    copy. Long-lived processes start a new one for every check, as the
+    style files may have changed meanwhile.
+    """
+
+    def __init__(self):
+        # directory -> path of the style file that applies to it,
+        # '' if there is none and clang-format uses its fallback style
+        self.paths = {}
+        # style file path -> sha1 of its contents
+        self.hashes = {}
+
+    def path(self, file):
+        """Path of the style file that applies to the given file."""
+        dirpath = os.path.dirname(os.path.abspath(file))
+        visited = []
+        while dirpath not in self.paths:
+            visited.append(dirpath)
+            style = self._read(dirpath)
+            if style is not None:
+                self.paths[dirpath] = style
+                break
+            parent = os.path.dirname(dirpath)
+            if parent == dirpath:
+                self.paths[dirpath] = ''
+                break
+            dirpath = parent
+        style = self.paths[dirpath]
+        for d in visited:
+            self.paths[d] = style
+        return style
+
+    def hash(self, file):
+        """Hash of the style file that applies to the given file,
+        '' if there is none."""
+        return self.hashes.get(self.path(file), '')
+
+    def _read(self, dirpath):
+        for name in STYLE_FILE_NAMES:
+            path = os.path.join(dirpath, name)
+            try:
+                with io.open(path, 'rb') as f:
+                    self.hashes[path] = hashlib.sha1(f.read()).hexdigest()
+                return path
+            except EnvironmentError:
+                pass
+        return None
+
+
+class ResultCache(object):
+    """Persistent record of file contents known to be formatted correctly.
+
+    Every entry is an empty file named after the hash of the file contents,
+    the effective .clang-format and the clang-format version string, so any
+    change to one of those is a cache miss. Hits bump the entry mtime, which
+    lets evict() drop the least recently used entries once the cache holds
+    more than max_entries of them.
+    """
+
+    def __init__(self, cache_dir, max_entries=DEFAULT_CACHE_SIZE):
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        self.max_entries = max_entries
+
+    def key(self, content, style_hash, version, extra=''):
+        h = hashlib.sha1(content)
+        h.update(b'\0' + style_hash.encode('utf-8'))
+        h.update(b'\0' + version.encode('utf-8'))
+        h.update(b'\0' + extra.encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key):
+        try:
+            os.utime(os.path.join(self.entries_dir, key), None)
+        except EnvironmentError:
+            return False
+        return True
+
+    def store(self, key):
+        try:
+            if not os.path.isdir(self.entries_dir):
+                os.makedirs(self.entries_dir)
+        except EnvironmentError as e:
+            # another worker may have created it concurrently
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            io.open(os.path.join(self.entries_dir, key), 'wb').close()
+        except EnvironmentError:
+            # the cache is an optimization, never fail validation over it
+            pass
+
+    def evict(self):
+        try:
+            names = os.listdir(self.entries_dir)
+        except EnvironmentError:
+            return
+        if len(names) <= self.max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.entries_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except EnvironmentError:
+                pass
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
 
 
 class DiffError(Exception):
-    def __init__(self, message, errs=None):
+    def __init__(self, message, errs=None, unusable=False):
         super(DiffError, self).__init__(message)
         self.errs = errs or []
+        # clang-format failed to start, or exited 127 as the shell or the
+        # dynamic loader do when it cannot run at all
+        self.unusable = unusable
 
 
 class UnexpectedError(Exception):
@@ -111,33 +856,181 @@ class UnexpectedError(Exception):
         self.exc = exc
 
 
-def run_clang_format_diff_wrapper(args, file):
+def run_clang_format_diff_batch_wrapper(args, files):
     try:
-        ret = run_clang_format_diff(args, file)
-        return ret
-    except DiffError:
-        raise
+        return run_clang_format_diff_batch(args, files)
     except Exception as e:
-        raise UnexpectedError('{}: {}: {}'.format(file, e.__class__.__name__,
-                                                  e), e)
+        raise UnexpectedError('{}: {}: {}'.format(', '.join(files),
+                                                  e.__class__.__name__, e), e)
 
 
-def run_clang_format_diff(args, file):
-    try:
-        with io.open(file, 'r', encoding='utf-8') as f:
-            original = f.readlines()
-    except IOError as exc:
-        raise DiffError(str(exc))
-    invocation = [args.clang_format_executable, file]
+def read_file(file, use_mmap=False):
+    """Reads the whole file, or maps it into memory with use_mmap.
 
-    # Use of utf-8 to decode the process output.
-    #
-    # Hopefully, this is the correct thing to do.
+    A mapping saves the copy into a bytes object, but unlike the copy it is
+    not a snapshot: the caller must close it and should not map files that
+    may be truncated meanwhile.
+    """
+    with io.open(file, 'rb') as f:
+        if use_mmap:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                pass
+        return f.read()
+
+
+class Source(object):
+    """A file read from disk, ready to be passed to clang-format."""
+
+    def __init__(self, file, content, lines, cache_key, stat=None):
+        self.file = file
+        self.content = content
+        self.size = len(content)
+        self.lines = lines
+        self.cache_key = cache_key
+        # os.stat() taken before reading, only needed by --fix
+        self.stat = stat
+        # seconds spent per stage of the check, see FileResult.timings
+        self.timings = {}
+        # why the file does not need to be checked, if it does not:
+        # 'cached' or 'unchanged'
+        self.skip = None
+
+    def data(self):
+        """The contents as bytes, copied out of the mapping if any."""
+        if isinstance(self.content, bytes):
+            return self.content
+        return self.content[:]
+
+    def close(self):
+        if not isinstance(self.content, bytes):
+            self.content.close()
+
+
+def read_source(args, file):
+    """Reads the file and returns a Source, whose skip attribute tells
+    whether the file needs to be checked at all.
+    """
+    if args.index_blobs is not None:
+        content = args.index_blobs.get(os.path.realpath(file))
+        if content is None:
+            raise DiffError('{}: not in the git index'.format(file))
+        st = None
+    else:
+        try:
+            st = os.stat(file) if args.fix else None
+            content = read_file(file, args.mmap)
+        except EnvironmentError as exc:
+            raise DiffError(str(exc))
+    source = Source(file, content, [], None, st)
+    if args.line_ranges is not None:
+        ranges = args.line_ranges.get(os.path.realpath(file))
+        if not ranges:
+            # nothing but metadata changed
+            source.skip = 'unchanged'
+            return source
+        source.lines = ['--lines={}:{}'.format(*r) for r in ranges]
+    if args.cache:
+        source.cache_key = args.cache.key(content, args.styles.hash(file),
+                                          args.clang_format_version,
+                                          ' '.join(source.lines))
+        if args.cache.lookup(source.cache_key):
+            source.skip = 'cached'
+    return source
+
+
+def add_timing(timings, stage, start):
+    """Adds the time elapsed since start to the stage of timings,
+    returns the current time.
+    """
+    now = time.time()
+    timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+
+class RunningProcesses(object):
+    """The clang-format processes started by the threads of this process,
+    so that the jobs still running can be killed when the run stops early.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = False
+
+    def add(self, proc):
+        with self.lock:
+            self.processes.add(proc)
+            if self.cancelled:
+                proc.kill()
+
+    def remove(self, proc):
+        with self.lock:
+            self.processes.discard(proc)
+
+    def cancel(self):
+        """Kills the running processes and the ones started from now on."""
+        with self.lock:
+            self.cancelled = True
+            self.kill()
+
+    def kill(self):
+        for proc in list(self.processes):
+            try:
+                proc.kill()
+            except OSError:
+                # already exited
+                pass
+
+    def reset(self):
+        with self.lock:
+            self.cancelled = False
+
+
+running_processes = RunningProcesses()
+
+
+def run_clang_format(invocation, input=None, timings=None):
+    """Runs clang-format, feeding it input on stdin if given,
+    and returns its raw output and its diagnostics as a list of lines.
+    Raises DiffError if it fails.
+
+    The time spent starting the process and waiting for it are added to the
+    'spawn' and 'format' stages of timings.
+    """
+    if timings is None:
+        timings = {}
+    if running_processes.cancelled:
+        raise DiffError("Command '{}' cancelled".format(
+            subprocess.list2cmdline(invocation)))
+    start = time.time()
+    try:
+        proc = subprocess.Popen(
+            invocation,
+            stdin=None if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    except OSError as exc:
+        raise DiffError(
+            "Command '{}' failed to start: {}".format(
+                subprocess.list2cmdline(invocation), exc
+            ),
+            unusable=True,
+        )
+    running_processes.add(proc)
+    start = add_timing(timings, 'spawn', start)
+    try:
+        # communicate() drains both pipes at once,
+        # so a chatty stderr cannot block the process
+        outs, errs = proc.communicate(input)
+    finally:
+        running_processes.remove(proc)
+    add_timing(timings, 'format', start)
+    # Use of utf-8 to decode the diagnostics.
     #
-    # It's done due to the following assumptions (which may be incorrect):
-    # - clang-format will returns the bytes read from the files as-is,
-    #   without conversion, and it is already assumed that the files use utf-8.
-    # - if the diagnostics were internationalized, they would use utf-8:
+    # If the diagnostics were internationalized, they would use utf-8:
     #   > Adding Translations to Clang
     #   >
     #   > Not possible yet!
@@ -146,45 +1039,953 @@ def run_clang_format_diff(args, file):
     #   > Each translation completely replaces the format string
     #   > for the diagnostic.
     #   > -- http://clang.llvm.org/docs/InternalsManual.html#internals-diag-translation
-    #
-    # It's not pretty, due to Python 2 & 3 compatibility.
-    encoding_py3 = {}
-    if sys.version_info[0] >= 3:
-        encoding_py3['encoding'] = 'utf-8'
+    errs = errs.decode('utf-8', 'replace').splitlines(True)
+    if proc.returncode:
+        raise DiffError(
+            "Command '{}' returned non-zero exit status {}".format(
+                subprocess.list2cmdline(invocation), proc.returncode
+            ),
+            errs,
+            unusable=proc.returncode == 127,
+        )
+    return outs, errs
+
 
+def diff_source(args, source, outs, errs, replacements=None):
+    """Turns the clang-format output for a source into its diff.
+
+    outs is the reformatted file, or the replacements document when
+    clang-format ran with --output-replacements-xml. The time spent is added
+    to the 'decode' and 'diff' stages of source.timings.
+    """
+    timings = source.timings
+    start = time.time()
     try:
-        proc = subprocess.Popen(
-            invocation,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            **encoding_py3)
+        if replacements is None and args.replacements:
+            documents = split_replacements(outs)
+            if len(documents) != 1:
+                raise DiffError(
+                    '{}: unexpected clang-format replacements output'.format(
+                        source.file), errs)
+            replacements = documents[0]
+            start = add_timing(timings, 'decode', start)
+        if replacements is not None:
+            diff = []
+            if len(replacements):
+                diff = make_replacements_diff(source.file, source.data(),
+                                              replacements)
+            if diff and args.fix:
+                outs = apply_replacements(source.data(), replacements)
+        elif memoryview(source.content) == outs:
+            # clang-format returns the bytes read from the file as-is,
+            # there is no need to decode anything when they match
+            diff = []
+        else:
+            # It is assumed that the files use utf-8.
+            original = split_lines(source.data())
+            reformatted = split_lines(outs)
+            start = add_timing(timings, 'decode', start)
+            diff = make_diff(source.file, original, reformatted)
+        add_timing(timings, 'diff', start)
+    except UnicodeDecodeError as exc:
+        raise DiffError('{}: {}'.format(source.file, exc), errs)
+    if diff and args.fix:
+        fix_source(args, source, outs)
+    elif source.cache_key and not diff and not errs:
+        args.cache.store(source.cache_key)
+    return diff
+
+
+def fix_source(args, source, reformatted):
+    """Replaces the file of source with its reformatted contents.
+
+    A symbolic link is left in place, the file it points to is replaced.
+    """
+    # the temporary file must be created next to the target for the
+    # rename over it to be atomic
+    path = os.path.realpath(source.file)
+    try:
+        st = os.stat(path)
+        if (st.st_size, st.st_mtime_ns) != (source.stat.st_size,
+                                            source.stat.st_mtime_ns):
+            raise DiffError('{}: modified while being formatted, not'
+                            ' fixed'.format(source.file))
+        write_file_atomic(path, reformatted, st.st_mode)
+    except EnvironmentError as exc:
+        raise DiffError('{}: could not fix: {}'.format(source.file, exc))
+    if args.cache and not source.lines:
+        # the next run can skip the freshly formatted file
+        args.cache.store(
+            args.cache.key(reformatted, args.styles.hash(source.file),
+                           args.clang_format_version))
+
+
+def clang_format_invocation(args, source):
+    """Command line checking source, whose contents go to stdin."""
+    invocation = [args.clang_format_executable] + source.lines
+    if args.replacements:
+        invocation.append('--output-replacements-xml')
+    # the file name is still needed to find the .clang-format
+    # and to guess the language
+    return invocation + ['--assume-filename=' + source.file]
+
+
+def split_replacements(output):
+    """Splits the concatenated --output-replacements-xml documents
+    clang-format prints for several files.
+    """
+    documents = []
+    for document in output.split(b'<?xml')[1:]:
+        documents.append(ElementTree.fromstring(b'<?xml' + document))
+    return documents
+
+
+def apply_replacements(content, replacements):
+    """Applies a <replacements> element to the raw file contents."""
+    chunks = []
+    end = len(content)
+    for r in reversed(replacements.findall('replacement')):
+        offset = int(r.get('offset'))
+        length = int(r.get('length'))
+        chunks.append(content[offset + length:end])
+        chunks.append((r.text or '').encode('utf-8'))
+        end = offset
+    chunks.append(content[:end])
+    return b''.join(reversed(chunks))
+
+
+class FileResult(object):
+    """Outcome of checking one file."""
+
+    def __init__(self, file, diff=None, errs=None, error=None):
+        self.file = file
+        self.diff = diff or []
+        self.errs = errs or []
+        # the DiffError that prevented checking the file, if any
+        self.error = error
+        # seconds of clang-format wall time spent on the file,
+        # None if clang-format did not run for it
+        self.duration = None
+        self.bytes_read = 0
+        # Source.skip of the file
+        self.skip = None
+        self.fixed = False
+        # seconds spent per stage: 'read' (and hash), 'spawn' (of the
+        # clang-format process), 'format', 'decode' (of the output) and
+        # 'diff', shared out by size for files checked in a batch
+        self.timings = {}
+        # time.time() when the check of the file started, the files of a
+        # batch are laid out one after the other
+        self.started = None
+        # the worker that checked the file, see current_worker()
+        self.worker = None
+
+    @property
+    def verdict(self):
+        if self.error:
+            return 'error'
+        if self.fixed:
+            return 'fixed'
+        if self.diff:
+            return 'diff'
+        if self.skip == 'cached':
+            return 'cached'
+        return 'clean'
+
+
+def current_worker():
+    """Identifies the pool process or thread running the caller."""
+    return '{}:{}'.format(os.getpid(), threading.get_ident())
+
+
+def check_batch(args, files, results, worker=None):
+    """Generator checking files with as few clang-format runs as possible.
+
+    Yields the (invocation, input) of every clang-format run it needs and
+    expects the (outs, errs) returned by run_clang_format() to be sent back
+    along with the timings it filled, or the DiffError it raised to be
+    thrown in. Appends a FileResult per file to results.
+    """
+    sources = []
+    first = len(results)
+    started = time.time()
+    try:
+        for file in files:
+            start = time.time()
+            try:
+                source = read_source(args, file)
+            except DiffError as e:
+                results.append(FileResult(file, error=e))
+                continue
+            add_timing(source.timings, 'read', start)
+            if source.skip:
+                result = FileResult(file)
+                result.bytes_read = source.size
+                result.skip = source.skip
+                result.timings = source.timings
+                results.append(result)
+                source.close()
+            else:
+                sources.append(source)
+
+        # --lines only works with a single input file,
+        # and the staged contents can only be passed on stdin
+        if (len(sources) > 1 and args.index_blobs is None
+                and not any(source.lines for source in sources)):
+            invocation = [args.clang_format_executable,
+                          '--output-replacements-xml'
+                          ] + [source.file for source in sources]
+            try:
+                outs, errs, timings = yield invocation, None
+                start = time.time()
+                documents = split_replacements(outs)
+                add_timing(timings, 'decode', start)
+            except (DiffError, ElementTree.ParseError):
+                # one broken file fails the whole batch,
+                # check the files one by one to tell which one it is
+                documents = []
+            if len(documents) == len(sources):
+                # the diagnostics of the batch are reported once,
+                # its time is shared out by file size
+                reported_errs = errs
+                total_size = sum(source.size + 1 for source in sources)
+                for source, replacements in zip(sources, documents):
+                    share = float(source.size + 1) / total_size
+                    for stage, seconds in timings.items():
+                        source.timings[stage] = seconds * share
+                    try:
+                        result = FileResult(
+                            source.file,
+                            diff_source(args, source, outs, errs,
+                                        replacements), reported_errs)
+                        result.fixed = bool(args.fix and result.diff)
+                    except DiffError as e:
+                        result = FileResult(source.file, error=e)
+                    result.timings = source.timings
+                    result.duration = (source.timings['spawn'] +
+                                       source.timings['format'])
+                    result.bytes_read = source.size
+                    results.append(result)
+                    reported_errs = []
+                return
+
+        for source in sources:
+            try:
+                outs, errs, timings = yield (clang_format_invocation(
+                    args, source), source.content)
+                source.timings.update(timings)
+                result = FileResult(source.file,
+                                    diff_source(args, source, outs, errs),
+                                    errs)
+                result.fixed = bool(args.fix and result.diff)
+                result.duration = timings['spawn'] + timings['format']
+            except DiffError as e:
+                result = FileResult(source.file, error=e)
+            result.timings = source.timings
+            result.bytes_read = source.size
+            results.append(result)
+    finally:
+        for source in sources:
+            source.close()
+        for result in results[first:]:
+            result.started = started
+            result.worker = worker or current_worker()
+            started += sum(result.timings.values())
+
+
+def run_clang_format_diff_batch(args, files, run=run_clang_format):
+    """Checks several files with a single clang-format process,
+    started by run, which is called like run_clang_format().
+
+    Returns a FileResult per file.
+    """
+    results = []
+    checker = check_batch(args, files, results)
+    reply = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                invocation, input = checker.send(reply)
+            else:
+                invocation, input = checker.throw(error)
+        except StopIteration:
+            return results
+        try:
+            timings = {}
+            outs, errs = run(invocation, input, timings)
+            reply = outs, errs, timings
+            error = None
+        except DiffError as e:
+            reply = None
+            error = e
+
+
+async def kill_process_async(proc):
+    """Kills an asyncio subprocess and waits for it to exit."""
+    if proc.returncode is None:
+        try:
+            if hasattr(signal, 'SIGKILL'):
+                # Process.kill() polls the process first, which can reap
+                # it before the child watcher does, and makes asyncio
+                # complain about an unknown child process
+                os.kill(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            # exited meanwhile
+            pass
+    await proc.wait()
+
+
+async def run_clang_format_async(invocation, input=None, timings=None):
+    """run_clang_format() for the asyncio backend."""
+    if timings is None:
+        timings = {}
+    start = time.time()
+    # a spawn cancelled halfway closes the transport, which polls the
+    # process like Process.kill() does: let it complete and kill the
+    # process afterwards
+    spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+        *invocation,
+        stdin=None if input is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE))
+    try:
+        proc = await asyncio.shield(spawn)
+    except asyncio.CancelledError:
+        try:
+            proc = await spawn
+        except OSError:
+            raise asyncio.CancelledError()
+        await kill_process_async(proc)
+        raise
     except OSError as exc:
         raise DiffError(
             "Command '{}' failed to start: {}".format(
                 subprocess.list2cmdline(invocation), exc
-            )
+            ),
+            unusable=True,
         )
-    proc_stdout = proc.stdout
-    proc_stderr = proc.stderr
-    if sys.version_info[0] < 3:
-        # make the pipes compatible with Python 3,
-        # reading lines should output unicode
-        encoding = 'utf-8'
-        proc_stdout = codecs.getreader(encoding)(proc_stdout)
-        proc_stderr = codecs.getreader(encoding)(proc_stderr)
-    # hopefully the stderr pipe won't get full and block the process
-    outs = list(proc_stdout.readlines())
-    errs = list(proc_stderr.readlines())
-    proc.wait()
+    start = add_timing(timings, 'spawn', start)
+    try:
+        outs, errs = await proc.communicate(
+            None if input is None else bytes(input))
+    except asyncio.CancelledError:
+        await kill_process_async(proc)
+        raise
+    add_timing(timings, 'format', start)
+    errs = errs.decode('utf-8', 'replace').splitlines(True)
     if proc.returncode:
         raise DiffError(
             "Command '{}' returned non-zero exit status {}".format(
                 subprocess.list2cmdline(invocation), proc.returncode
             ),
             errs,
+            unusable=proc.returncode == 127,
         )
-    return make_diff(file, original, outs), errs
+    return outs, errs
+
+
+async def run_clang_format_diff_batch_async(args, files, slots):
+    """run_clang_format_diff_batch() for the asyncio backend, running at most
+    as many batches at once as there are slot numbers in the slots queue.
+    """
+    try:
+        results = []
+        # the whole batch holds a slot, so that the batches waiting for one
+        # neither read their files early nor show up as running in traces
+        slot = await slots.get()
+        try:
+            checker = check_batch(args, files, results,
+                                  'asyncio:{}'.format(slot))
+            reply = None
+            error = None
+            while True:
+                try:
+                    if error is None:
+                        invocation, input = checker.send(reply)
+                    else:
+                        invocation, input = checker.throw(error)
+                except StopIteration:
+                    return results
+                try:
+                    timings = {}
+                    outs, errs = await run_clang_format_async(
+                        invocation, input, timings)
+                    reply = outs, errs, timings
+                    error = None
+                except DiffError as e:
+                    reply = None
+                    error = e
+        finally:
+            slots.put_nowait(slot)
+    except (DiffError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        raise UnexpectedError('{}: {}: {}'.format(', '.join(files),
+                                                  e.__class__.__name__, e), e)
+
+
+def cgroup_dirs(controller):
+    """Directories of the cgroup of this process for a controller, from its
+    own up to the root of the hierarchy, the limits of all of them apply.
+    Looks for the cgroup v1 hierarchy of the controller first, then for
+    the unified v2 one, at their usual mount points.
+    """
+    try:
+        with io.open('/proc/self/cgroup', 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except EnvironmentError:
+        return []
+    unified = None
+    for line in lines:
+        parts = line.split(':', 2)
+        if len(parts) != 3:
+            continue
+        controllers = parts[1].split(',')
+        if controller in controllers:
+            for name in (parts[1], controller):
+                mount = os.path.join(CGROUP_ROOT, name)
+                if os.path.isdir(mount):
+                    break
+            else:
+                continue
+            return cgroup_ancestors(mount, parts[2])
+        if parts[0] == '0' and parts[1] == '':
+            unified = parts[2]
+    if unified is None:
+        return []
+    for mount in (CGROUP_ROOT, os.path.join(CGROUP_ROOT, 'unified')):
+        if os.path.isfile(os.path.join(mount, 'cgroup.controllers')):
+            return cgroup_ancestors(mount, unified)
+    return []
+
+
+def cgroup_ancestors(mount, path):
+    dirs = []
+    path = path.strip('/')
+    while True:
+        directory = os.path.join(mount, path)
+        # inside a container the path may be relative to another root
+        if os.path.isdir(directory):
+            dirs.append(directory)
+        if not path:
+            return dirs
+        path = os.path.dirname(path)
+
+
+def read_cgroup_file(directory, name):
+    try:
+        with io.open(os.path.join(directory, name), 'r',
+                     encoding='utf-8') as f:
+            return f.read().split()
+    except EnvironmentError:
+        return []
+
+
+def cgroup_cpu_limit():
+    """Number of cpus the cgroup CPU quota allows, None if unlimited."""
+    limit = None
+    for directory in cgroup_dirs('cpu'):
+        # v2: "$MAX $PERIOD", v1: separate files, -1 when unlimited
+        values = read_cgroup_file(directory, 'cpu.max')
+        if not values:
+            values = (read_cgroup_file(directory, 'cpu.cfs_quota_us') +
+                      read_cgroup_file(directory, 'cpu.cfs_period_us'))
+        try:
+            quota, period = int(values[0]), int(values[1])
+        except (IndexError, ValueError):
+            # "max" or nothing
+            continue
+        if quota > 0 and period > 0:
+            cpus = max(1, -(-quota // period))
+            limit = cpus if limit is None else min(limit, cpus)
+    return limit
+
+
+def cgroup_memory_limit():
+    """The cgroup memory limit in bytes, None if unlimited."""
+    limit = None
+    for directory in cgroup_dirs('memory'):
+        values = (read_cgroup_file(directory, 'memory.max') or
+                  read_cgroup_file(directory, 'memory.limit_in_bytes'))
+        try:
+            value = int(values[0])
+        except (IndexError, ValueError):
+            continue
+        # v1 reports "no limit" as a huge page-aligned number
+        if value < 2**62:
+            limit = value if limit is None else min(limit, value)
+    return limit
+
+
+def default_jobs():
+    """Default number of clang-format jobs: one more than the cpus this
+    process may run on, according to its affinity and cgroup CPU quota,
+    and no more than the cgroup memory limit can fit.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on Windows and macOS
+        cpus = multiprocessing.cpu_count()
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    njobs = cpus + 1
+    memory = cgroup_memory_limit()
+    if memory is not None:
+        njobs = min(njobs, memory // MEMORY_PER_JOB)
+    return max(1, njobs)
+
+
+class JobTuner(object):
+    """Throughput of the job counts previous runs used on this host,
+    for --tune-jobs.
+
+    Starting from default_jobs(), every run tries the untested neighbour
+    of the best job count so far, higher ones first, until both
+    neighbours are known to be slower. The best job count is the smallest
+    one about as fast as the fastest.
+    """
+
+    # runs with fewer files per job say little about the throughput
+    MIN_FILES_PER_JOB = 4
+    # more jobs must be faster by more than this share to be worth it
+    TOLERANCE = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self.host = socket.gethostname()
+        self.entries = {}
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (EnvironmentError, ValueError):
+            pass
+        # job count (as a string, like in json) -> bytes per second
+        self.throughputs = self.entries.setdefault(self.host, {})
+
+    def best(self):
+        if not self.throughputs:
+            return None
+        fastest = max(self.throughputs.values())
+        return min(
+            int(njobs) for njobs, throughput in self.throughputs.items()
+            if throughput >= fastest * (1 - self.TOLERANCE))
+
+    def choose(self, default):
+        best = self.best()
+        if best is None:
+            return default
+        step = max(1, best // 4)
+        for candidate in (best + step, best - step):
+            if candidate >= 1 and str(candidate) not in self.throughputs:
+                return candidate
+        return best
+
+    def record(self, njobs, nfiles, nbytes, seconds):
+        if nfiles < njobs * self.MIN_FILES_PER_JOB or seconds <= 0:
+            return
+        throughput = nbytes / seconds
+        previous = self.throughputs.get(str(njobs))
+        if previous is not None:
+            # smooth out the noise of single runs
+            throughput = (previous + throughput) / 2
+        self.throughputs[str(njobs)] = throughput
+        try:
+            write_file_atomic(self.path,
+                              json.dumps(self.entries).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+
+class DurationHistory(object):
+    """Per-file clang-format wall times of previous runs,
+    used to hand out the slowest files first.
+
+    A history without a path starts empty and is never saved.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        # real paths of the files recorded by this run
+        self.recorded = set()
+        try:
+            if path:
+                with io.open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+        except (EnvironmentError, ValueError):
+            pass
+        durations = sum(e[0] for e in self.entries.values())
+        sizes = sum(e[1] for e in self.entries.values())
+        self.seconds_per_byte = durations / sizes if sizes else 0.0
+
+    def estimate(self, file, size):
+        """Expected duration of file, extrapolated from its size if it was
+        never checked before."""
+        entry = self.entries.get(os.path.realpath(file))
+        if entry is None:
+            return size * self.seconds_per_byte
+        return entry[0]
+
+    def record(self, file, duration):
+        path = os.path.realpath(file)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.entries[path] = (duration, size)
+        self.recorded.add(path)
+
+    def save(self):
+        if not self.path or not self.recorded:
+            return
+        entries = self.entries
+        if len(entries) > self.max_entries:
+            # keep the files of this run first
+            paths = sorted(entries, key=lambda path: path not in self.recorded)
+            entries = dict((path, entries[path])
+                           for path in paths[:self.max_entries])
+        try:
+            write_file_atomic(self.path, json.dumps(entries).encode('utf-8'))
+        except EnvironmentError:
+            # like the result cache, never fail validation over it
+            pass
+
+
+class FileInventory(object):
+    """(inode, size, mtime) of the files found formatted correctly by
+    previous runs, so that they can be told unchanged by a stat alone,
+    without reading and hashing them for the result cache.
+
+    The inventory is dropped as a whole when the clang-format version
+    changes, an entry when the style hash of its file does. Files modified
+    too recently to tell a later write from the one seen by their stat are
+    not recorded, like racily clean entries of the git index.
+    """
+
+    # coarsest mtime resolution of common file systems (FAT)
+    MTIME_GRANULARITY_NS = 2 * 10**9
+
+    def __init__(self, path, version, max_entries=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.files = {}
+        self.changed = False
+        # real path -> (stat tuple, style hash) of the files looked up
+        self.seen = {}
+        self.started_ns = time.time_ns()
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            if entries['version'] == version:
+                self.files = entries['files']
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            pass
+
+    def split(self, files, styles):
+        """Splits files into those to check and those unchanged since
+        they were found formatted correctly, styles is the StyleResolver
+        of the run."""
+        changed = []
+        unchanged = []
+        for file in files:
+            path = os.path.realpath(file)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # let the check report it
+                changed.append(file)
+                continue
+            entry = [st.st_ino, st.st_size, st.st_mtime_ns,
+                     styles.hash(file)]
+            self.seen[path] = entry
+            if self.files.get(path) == entry:
+                unchanged.append(file)
+            else:
+                if self.files.pop(path, None) is not None:
+                    self.changed = True
+                changed.append(file)
+        return changed, unchanged
+
+    def record(self, file):
+        """Records file as formatted correctly, as of its stat by split()."""
+        path = os.path.realpath(file)
+        entry = self.seen.get(path)
+        if entry is None or self.files.get(path) == entry:
+            return
+        if entry[2] >= self.started_ns - self.MTIME_GRANULARITY_NS:
+            return
+        self.files[path] = entry
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        files = self.files
+        if len(files) > self.max_entries:
+            # keep the files of this run first
+            paths = sorted(files, key=lambda path: path not in self.seen)
+            files = dict((path, files[path])
+                         for path in paths[:self.max_entries])
+        try:
+            write_file_atomic(self.path, json.dumps({
+                'version': self.version,
+                'files': files,
+            }).encode('utf-8'))
+        except EnvironmentError:
+            pass
+
+
+def write_file_atomic(path, data, mode=None):
+    """Replaces the file at path with data, readers see either the old or
+    the new contents, never a partially written file.
+    """
+    dirpath = os.path.dirname(path) or '.'
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    fd, tmp = tempfile.mkstemp(dir=dirpath,
+                               prefix='.' + os.path.basename(path),
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, stat.S_IMODE(mode))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def schedule_files(files, policy, history=None):
+    """Orders files in which the jobs pick them up.
+
+    - walk: the order in which they were listed
+    - largest: largest files first, so no big file is left for last
+      while the other jobs sit idle
+    - recent: most recently modified first, likely format violations
+      are reported early
+    - history: slowest files first according to the durations of
+      previous runs, by size for files without any
+    """
+    if policy == 'walk':
+        return files
+    keys = {}
+    for file in files:
+        try:
+            st = os.stat(file)
+        except OSError:
+            keys[file] = 0
+            continue
+        if policy == 'largest':
+            keys[file] = st.st_size
+        elif policy == 'recent':
+            keys[file] = st.st_mtime
+        else:
+            keys[file] = history.estimate(file, st.st_size)
+    return sorted(files, key=keys.get, reverse=True)
+
+
+def parse_shard(value):
+    """Parses the INDEX/COUNT of --shard, INDEX going from 1 to COUNT."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected INDEX/COUNT, got {!r}'.format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            'shard index must be between 1 and {}'.format(count))
+    return index, count
+
+
+def shard_files(files, index, count, policy='hash', history=None):
+    """The files of shard index (from 1) out of count, in their order.
+
+    Every shard must get the same files and policy for the shards to
+    cover them all exactly once:
+
+    - hash: by a hash of the normalized path, stable across runs
+    - cost: balanced by the estimated duration of the files, largest
+      first onto the least loaded shard; the estimates come from the
+      history, which must then be the same for all shards
+    """
+    if count == 1:
+        return files
+    if policy == 'hash':
+        selected = set()
+        for file in files:
+            path = os.path.normpath(file).replace(os.sep, '/')
+            digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+            if int(digest, 16) % count == index - 1:
+                selected.add(file)
+    else:
+        costs = {}
+        for file in files:
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                size = 0
+            costs[file] = history.estimate(file, size)
+        loads = [0.0] * count
+        selected = set()
+        # ties are broken by path, so that every shard agrees on the order
+        for file in sorted(files, key=lambda f: (-costs[f], f)):
+            shard = loads.index(min(loads))
+            loads[shard] += costs[file]
+            if shard == index - 1:
+                selected.add(file)
+    return [file for file in files if file in selected]
+
+
+def make_batches(files, njobs, batch_size, styles):
+    """Splits files into the chunks given to one clang-format process each.
+
+    A chunk is closed once it holds batch_size files or MAX_BATCH_BYTES of
+    sources. A batch_size of 0 aims at several chunks per job, by count and
+    by bytes, so the jobs stay balanced whatever the order of the files:
+    the large files get chunks of their own and the small ones are grouped.
+    Files of different styles never share a chunk, the chunks come in the
+    order of their first file.
+    """
+    if batch_size == 1:
+        return [[file] for file in files]
+    sizes = []
+    for file in files:
+        try:
+            sizes.append(os.path.getsize(file))
+        except OSError:
+            sizes.append(0)
+    max_bytes = MAX_BATCH_BYTES
+    if batch_size == 0:
+        batch_size = len(files) // (njobs * 4)
+        batch_size = max(1, min(MAX_BATCH_SIZE, batch_size))
+        max_bytes = max(1, min(MAX_BATCH_BYTES, sum(sizes) // (njobs * 4)))
+    batches = []
+    # style file path -> [open chunk, its bytes]
+    open_batches = {}
+    for file, size in zip(files, sizes):
+        style = styles.path(file)
+        batch = open_batches.get(style)
+        if batch is None or (len(batch[0]) == batch_size
+                             or batch[1] + size > max_bytes):
+            batch = open_batches[style] = [[], 0]
+            batches.append(batch[0])
+        batch[0].append(file)
+        batch[1] += size
+    return batches
+
+
+def iter_serial_results(args, batches, njobs):
+    # execute directly instead of in a pool,
+    # less overhead, simpler stacktraces
+    for batch in batches:
+        yield run_clang_format_diff_batch_wrapper(args, batch)
+
+
+def iter_prepended_results(results, it):
+    """Yields results, then the lists of results of the iterator it,
+    which closing the generator closes."""
+    try:
+        yield results
+        for results in it:
+            yield results
+    finally:
+        it.close()
+
+
+def kill_on_sigterm():
+    # Pool.terminate() stops the workers with SIGTERM,
+    # do not leave their clang-format processes running
+    def handler(signum, frame):
+        running_processes.kill()
+        os._exit(1)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def iter_process_results(args, batches, njobs):
+    pool = multiprocessing.Pool(njobs, initializer=kill_on_sigterm)
+    try:
+        for results in pool.imap_unordered(
+                partial(run_clang_format_diff_batch_wrapper, args), batches):
+            yield results
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_thread_results(args, batches, njobs):
+    executor = ThreadPoolExecutor(njobs)
+    futures = [
+        executor.submit(run_clang_format_diff_batch_wrapper, args, batch)
+        for batch in batches
+    ]
+    done = False
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+        done = True
+    finally:
+        for future in futures:
+            future.cancel()
+        if not done:
+            # the consumer stopped early, do not wait for the running jobs
+            running_processes.cancel()
+        executor.shutdown()
+        running_processes.reset()
+
+
+def iter_asyncio_results(args, batches, njobs):
+    # The event loop only runs while waiting for the next result,
+    # meanwhile the clang-format processes keep running on their own.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queue = asyncio.Queue()
+    tasks = []
+
+    async def check(batch, slots):
+        try:
+            queue.put_nowait(await run_clang_format_diff_batch_async(
+                args, batch, slots))
+        except UnexpectedError as e:
+            queue.put_nowait(e)
+
+    async def start():
+        slots = asyncio.Queue()
+        for slot in range(1, njobs + 1):
+            slots.put_nowait(slot)
+        tasks.extend(
+            loop.create_task(check(batch, slots)) for batch in batches)
+
+    try:
+        loop.run_until_complete(start())
+        for _ in batches:
+            results = loop.run_until_complete(queue.get())
+            if isinstance(results, UnexpectedError):
+                raise results
+            yield results
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+BACKENDS = {
+    'process': iter_process_results,
+    'thread': iter_thread_results,
+    'asyncio': iter_asyncio_results,
+}
 
 
 def bold_red(s):
@@ -220,10 +2021,7 @@ def colorize(diff_lines):
 def print_diff(diff_lines, use_color):
     if use_color:
         diff_lines = colorize(diff_lines)
-    if sys.version_info[0] < 3:
-        sys.stdout.writelines((l.encode('utf-8') for l in diff_lines))
-    else:
-        sys.stdout.writelines(diff_lines)
+    sys.stdout.writelines(diff_lines)
 
 
 def print_trouble(prog, message, use_colors):
@@ -233,13 +2031,955 @@ def print_trouble(prog, message, use_colors):
     print("{}: {} {}".format(prog, error_text, message), file=sys.stderr)
 
 
+class Profile(object):
+    """Where the time of a run goes, for --profile.
+
+    main() times the stages it runs itself (file discovery, printing) and
+    the execution of the checks, the per-file stages come from the
+    timings of the FileResults.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.files = []
+        self.execution = 0.0
+
+    def add(self, result):
+        busy = sum(result.timings.values())
+        self.files.append((busy, result.file))
+        for stage, seconds in result.timings.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def write(self, out, njobs, backend, slowest):
+        wall = time.time() - self.start
+        out.write('profile: {:.3f}s wall, {} files, {} jobs ({})\n'.format(
+            wall, len(self.files), njobs, backend))
+        stages = [stage for stage in ('discovery', ) + FILE_STAGES +
+                  ('print', ) if stage in self.stages]
+        for stage in stages:
+            out.write('  {:<10} {:9.3f}s\n'.format(stage,
+                                                  self.stages[stage]))
+        busy = sum(seconds for seconds, _ in self.files)
+        if self.execution > 0:
+            # the worker stages add up to the time jobs were busy,
+            # compare it to the time they were available
+            out.write('  worker utilization {:.0%} ({:.3f}s busy of'
+                      ' {} x {:.3f}s)\n'.format(
+                          busy / (njobs * self.execution), busy, njobs,
+                          self.execution))
+        if slowest > 0 and self.files:
+            out.write('  slowest files:\n')
+            self.files.sort(key=lambda item: item[0], reverse=True)
+            for seconds, file in self.files[:slowest]:
+                out.write('  {:9.3f}s {}\n'.format(seconds, file))
+
+
+class Trace(object):
+    """Timeline of a run in the Chrome trace event format, for --trace-file.
+
+    Opens in chrome://tracing or https://ui.perfetto.dev. Every worker gets
+    a track with a span per file, split into the FileResult.timings stages,
+    and main() gets one with the time it spends printing the results.
+    """
+
+    def __init__(self):
+        self.files = []
+        self.prints = []
+
+    def add(self, result):
+        if result.started is not None:
+            self.files.append(result)
+
+    def add_print(self, start, end):
+        self.prints.append((start, end))
+
+    def events(self):
+        def span(name, category, tid, start, seconds, args=None):
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'pid': 1,
+                'tid': tid,
+                'ts': round((start - origin) * 1e6, 1),
+                'dur': round(seconds * 1e6, 1),
+            }
+            if args:
+                event['args'] = args
+            return event
+
+        starts = [result.started for result in self.files]
+        starts.extend(start for start, _ in self.prints)
+        origin = min(starts) if starts else 0
+        events = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': 1,
+            'tid': 0,
+            'args': {'name': 'main'},
+        }]
+        for start, end in self.prints:
+            events.append(span('print', 'print', 0, start, end - start))
+
+        # worker -> track, numbered by their first file
+        tracks = {}
+        self.files.sort(key=lambda result: result.started)
+        for result in self.files:
+            end = result.started + sum(result.timings.values())
+            tid = tracks.get(result.worker)
+            if tid is None:
+                tid = tracks[result.worker] = len(tracks) + 1
+                events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': 1,
+                    'tid': tid,
+                    'args': {'name': 'job {} ({})'.format(tid,
+                                                          result.worker)},
+                })
+            events.append(span(result.file, 'file', tid, result.started,
+                               end - result.started,
+                               {'verdict': result.verdict}))
+            start = result.started
+            for stage in FILE_STAGES:
+                seconds = result.timings.get(stage)
+                if seconds is not None:
+                    events.append(span(stage, 'stage', tid, start, seconds))
+                    start += seconds
+        return events
+
+    def write(self, path):
+        write_file_atomic(
+            path,
+            json.dumps({
+                'traceEvents': self.events(),
+                'displayTimeUnit': 'ms',
+            }).encode('utf-8'))
+
+
+def diff_stats(diff):
+    """Number of hunks and of changed lines in a unified diff."""
+    hunks = 0
+    changed = 0
+    # skip the ---/+++ header
+    for line in diff[2:]:
+        if line.startswith('@@ '):
+            hunks += 1
+        elif line[:1] in ('+', '-'):
+            changed += 1
+    return hunks, changed
+
+
+def report_entry(result):
+    hunks, changed = diff_stats(result.diff)
+    entry = {
+        'file': result.file,
+        'verdict': result.verdict,
+        'hunks': hunks,
+        'changed_lines': changed,
+        'duration': result.duration or 0.0,
+        'bytes_read': result.bytes_read,
+    }
+    if result.error:
+        entry['error'] = str(result.error)
+    if result.diff:
+        # @@ -start[,count] +start[,count] @@
+        start = result.diff[2].split()[1][1:].split(',')[0]
+        entry['line'] = max(1, int(start))
+        entry['diff'] = ''.join(result.diff)
+    return entry
+
+
+def json_report(entries, summary):
+    report = dict(summary)
+    report['files'] = entries
+    return json.dumps(report, indent=2, sort_keys=True).encode('utf-8')
+
+
+def sarif_report(entries, summary):
+    rules = [
+        {
+            'id': 'format',
+            'shortDescription': {
+                'text': 'The file is not formatted according to its'
+                ' .clang-format style'
+            },
+        },
+        {
+            'id': 'error',
+            'shortDescription': {
+                'text': 'clang-format could not check the file'
+            },
+        },
+    ]
+    artifacts = []
+    results = []
+    for index, entry in enumerate(entries):
+        uri = entry['file'].replace(os.sep, '/')
+        artifacts.append({
+            'location': {'uri': uri},
+            'length': entry['bytes_read'],
+            'properties': {
+                'verdict': entry['verdict'],
+                'duration': entry['duration'],
+                'hunks': entry['hunks'],
+                'changedLines': entry['changed_lines'],
+            },
+        })
+        if entry['verdict'] == 'error':
+            result = {
+                'ruleId': 'error',
+                'level': 'error',
+                'message': {'text': entry['error']},
+            }
+        elif entry['verdict'] in ('diff', 'fixed'):
+            result = {
+                'ruleId': 'format',
+                'level': 'note' if entry['verdict'] == 'fixed' else 'error',
+                'message': {
+                    'text': '{} hunk(s), {} changed line(s) to reformat'
+                    .format(entry['hunks'], entry['changed_lines'])
+                },
+            }
+        else:
+            continue
+        location = {'artifactLocation': {'uri': uri, 'index': index}}
+        if 'line' in entry:
+            location['region'] = {'startLine': entry['line']}
+        result['locations'] = [{'physicalLocation': location}]
+        results.append(result)
+    report = {
+        '$schema': 'https://json.schemastore.org/sarif-2.1.0.json',
+        'version': '2.1.0',
+        'runs': [{
+            'tool': {
+                'driver': {
+                    'name': 'clang-format-validate',
+                    'version': summary['clang_format_version'],
+                    'rules': rules,
+                }
+            },
+            'invocations': [{
+                'executionSuccessful':
+                summary['exit_code'] != ExitStatus.TROUBLE,
+                'exitCode': summary['exit_code'],
+            }],
+            'artifacts': artifacts,
+            'results': results,
+        }],
+    }
+    return json.dumps(report, indent=2, sort_keys=True).encode('utf-8')
+
+
+def junit_report(entries, summary):
+    suite = ElementTree.Element(
+        'testsuite',
+        name='clang-format',
+        tests=str(len(entries)),
+        failures=str(sum(1 for e in entries if e['verdict'] == 'diff')),
+        errors=str(sum(1 for e in entries if e['verdict'] == 'error')),
+        time='{:.3f}'.format(summary['duration']))
+    for entry in entries:
+        case = ElementTree.SubElement(
+            suite,
+            'testcase',
+            classname=os.path.dirname(entry['file']),
+            name=os.path.basename(entry['file']),
+            time='{:.3f}'.format(entry['duration']))
+        properties = ElementTree.SubElement(case, 'properties')
+        for name in ('verdict', 'bytes_read', 'hunks', 'changed_lines'):
+            ElementTree.SubElement(properties,
+                                   'property',
+                                   name=name,
+                                   value=str(entry[name]))
+        if entry['verdict'] == 'error':
+            error = ElementTree.SubElement(case,
+                                           'error',
+                                           message=entry['error'])
+            error.text = entry['error']
+        elif entry['verdict'] == 'diff':
+            failure = ElementTree.SubElement(
+                case,
+                'failure',
+                message='{} hunk(s), {} changed line(s) to reformat'.format(
+                    entry['hunks'], entry['changed_lines']))
+            failure.text = entry['diff']
+        elif entry['verdict'] == 'fixed':
+            # --fix succeeded for the file, the test case passes
+            ElementTree.SubElement(case, 'system-out').text = entry['diff']
+    suites = ElementTree.Element('testsuites')
+    suites.append(suite)
+    out = io.BytesIO()
+    ElementTree.ElementTree(suites).write(out,
+                                          encoding='utf-8',
+                                          xml_declaration=True)
+    return out.getvalue()
+
+
+REPORT_FORMATS = {
+    'json': json_report,
+    'sarif': sarif_report,
+    'junit': junit_report,
+}
+
+
+def merge_reports(paths):
+    """Combines the JSON reports of the shards of a run into the entries
+    and summary of a single report.
+
+    Raises ValueError if a report cannot be read, or if the reports are
+    not the complete set of shards of one run.
+    """
+    entries = []
+    summary = {'exit_code': ExitStatus.SUCCESS, 'duration': 0.0}
+    versions = set()
+    shards = []
+    for path in paths:
+        try:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                report = json.load(f)
+        except (EnvironmentError, ValueError) as e:
+            raise ValueError('could not read {}: {}'.format(path, e))
+        if 'files' not in report:
+            raise ValueError('{}: not a JSON report'.format(path))
+        entries.extend(report['files'])
+        versions.add(report.get('clang_format_version'))
+        if 'shard' in report:
+            shards.append(report['shard'])
+        summary['exit_code'] = max(summary['exit_code'],
+                                   report.get('exit_code', 0))
+        # the shards run side by side
+        summary['duration'] = max(summary['duration'],
+                                  report.get('duration', 0.0))
+    if len(versions) > 1:
+        raise ValueError('the reports come from different clang-format'
+                         ' versions: {}'.format(', '.join(
+                             sorted(str(v) for v in versions))))
+    summary['clang_format_version'] = versions.pop() if versions else None
+    if shards:
+        count = int(shards[0].split('/')[1])
+        expected = ['{}/{}'.format(i, count) for i in range(1, count + 1)]
+        if sorted(shards) != sorted(expected):
+            raise ValueError(
+                'expected the reports of shards {}, got {}'.format(
+                    ', '.join(expected), ', '.join(shards)))
+    entries.sort(key=lambda entry: entry['file'])
+    return entries, summary
+
+
+class PollingWatcher(object):
+    """Finds the files that changed by listing and stat()ing them all
+    again every interval seconds.
+    """
+
+    def __init__(self, args, exclude, interval):
+        self.args = args
+        self.exclude = exclude
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for file in list_files(self.args.files,
+                               recursive=self.args.recursive,
+                               exclude=self.exclude,
+                               extensions=self.args.extensions.split(',')):
+            snapshot[os.path.realpath(file)] = stat_signature(file)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """Real paths of the files created, changed or deleted since the
+        previous call, an empty set if there are none after timeout
+        seconds, None meaning until there are.
+        """
+        while True:
+            time.sleep(self.interval if timeout is None else min(
+                self.interval, timeout))
+            snapshot = self.scan()
+            changed = set(
+                path for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Gets the files that changed from inotify, watching every directory
+    below the roots that list_files() does not prune. Linux only, raises
+    OSError when inotify is not available or out of watches, from wait()
+    too for the directories created meanwhile.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE)
+
+    def __init__(self, args, exclude):
+        import ctypes
+        import ctypes.util
+        self.args = args
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.get_errno = ctypes.get_errno
+        # watch descriptor -> (real path, path as listed, ExcludeMatcher of
+        # the contents) of the watched directories
+        self.dirs = {}
+        # a full rescan is needed when the kernel dropped events
+        self.overflowed = False
+        try:
+            for root in args.files:
+                if os.path.isdir(root):
+                    if args.recursive:
+                        self.add_tree(root, exclude)
+                    else:
+                        self.add(root, exclude)
+                else:
+                    self.add(os.path.dirname(root) or '.', exclude)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, directory, exclude):
+        wd = self.libc.inotify_add_watch(self.fd,
+                                         os.fsencode(directory), self.MASK)
+        if wd < 0:
+            error = self.get_errno()
+            raise OSError(error, '{}: {}'.format(os.strerror(error),
+                                                 directory))
+        self.dirs[wd] = (os.path.realpath(directory), directory, exclude)
+
+    def add_tree(self, top, exclude):
+        """Watches top and the directories below it that list_files()
+        would walk, with exclude the matcher of the directory containing
+        top. Returns the real paths of the files in them.
+        """
+        files = []
+        # same pruning as _walk()
+        stack = [(top, exclude)]
+        while stack:
+            dirpath, exclude = stack.pop()
+            try:
+                entries = list(os.scandir(dirpath))
+            except OSError:
+                continue
+            exclude = exclude.for_directory(
+                dirpath,
+                any(e.name == DEFAULT_CLANG_FORMAT_IGNORE for e in entries))
+            try:
+                self.add(dirpath, exclude)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # already gone
+                continue
+            for entry in entries:
+                path = os.path.join(dirpath, entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(os.path.realpath(path))
+                elif not entry.is_symlink() and not exclude.prune(path):
+                    stack.append((path, exclude))
+        return files
+
+    def wait(self, timeout=None):
+        """Same as PollingWatcher.wait()."""
+        changed = set()
+        while not changed:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                break
+            data = os.read(self.fd, 64 * 1024)
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = struct.unpack_from('iIII', data, pos)
+                pos += 16
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    continue
+                watched = self.dirs.get(wd)
+                if watched is None:
+                    continue
+                directory, listed, exclude = watched
+                path = os.path.join(directory, name)
+                if mask & self.IN_ISDIR:
+                    listed = os.path.join(listed, name)
+                    if (mask & (self.IN_CREATE | self.IN_MOVED_TO)
+                            and self.args.recursive
+                            and not exclude.prune(listed)):
+                        changed.update(self.add_tree(listed, exclude))
+                else:
+                    changed.add(path)
+            if self.overflowed:
+                break
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def stat_signature(file):
+    """What changes when a file is written, None if it does not exist."""
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def make_watcher(prog, args, exclude):
+    """An InotifyWatcher of the files under the roots where inotify works,
+    a PollingWatcher otherwise or with --watch-interval."""
+    if sys.platform.startswith('linux') and not args.watch_interval:
+        try:
+            return InotifyWatcher(args, exclude)
+        except OSError as e:
+            sys.stderr.write(
+                '{}: falling back to polling: {}\n'.format(prog, e))
+    return PollingWatcher(args, exclude, args.watch_interval or 1.0)
+
+
+def watch(prog, args, exclude, njobs, table, colored_stdout,
+          colored_stderr):
+    """main() of --watch, once the initial validation is done.
+
+    Waits for files to change and validates them again, waiting for bursts
+    of saves to settle first. table maps the real path of every validated
+    file to its stat_signature() at the time, files whose signature did not
+    change are not checked again.
+    """
+    watcher = make_watcher(prog, args, exclude)
+    sys.stderr.write('watching for changes, press Ctrl+C to stop\n')
+    while True:
+        rescan = False
+        try:
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(args.watch_debounce)
+                if not more:
+                    break
+                changed |= more
+        except OSError as e:
+            # e.g. out of inotify watches for a new directory
+            sys.stderr.write(
+                '{}: falling back to polling: {}\n'.format(prog, e))
+            watcher.close()
+            watcher = PollingWatcher(args, exclude, 1.0)
+            rescan = True
+        if rescan or getattr(watcher, 'overflowed', False):
+            # the events are incomplete, fall back to the signatures
+            watcher.overflowed = False
+            changed = set(table) | set(
+                os.path.realpath(file) for file in list_files(
+                    args.files,
+                    recursive=args.recursive,
+                    exclude=exclude,
+                    extensions=args.extensions.split(',')))
+
+        files = []
+        for file in select_paths(sorted(changed), args.files, args.recursive,
+                                 args.extensions.split(','), exclude):
+            path = os.path.realpath(file)
+            signature = stat_signature(path)
+            if signature is None:
+                table.pop(path, None)
+            elif table.get(path) != signature:
+                table[path] = signature
+                files.append(file)
+        if not files:
+            continue
+
+        # the style files may have changed as well
+        args.styles = StyleResolver()
+        batches = [[file] for file in files]
+        jobs = min(len(batches), njobs)
+        if jobs == 1:
+            it = iter_serial_results(args, batches, jobs)
+        else:
+            it = BACKENDS[args.backend](args, batches, jobs)
+        try:
+            for results in it:
+                for result in results:
+                    if result.error:
+                        print_trouble(prog, str(result.error),
+                                      use_colors=colored_stderr)
+                        sys.stderr.writelines(result.error.errs)
+                        continue
+                    sys.stderr.writelines(result.errs)
+                    if result.fixed:
+                        # do not check it again for our own write
+                        table[os.path.realpath(result.file)] = (
+                            stat_signature(result.file))
+                    if args.quiet:
+                        continue
+                    if not result.diff:
+                        sys.stdout.write('{}: ok\n'.format(result.file))
+                    elif args.fix:
+                        sys.stdout.write('reformatted {}\n'.format(
+                            result.file))
+                    else:
+                        print_diff(result.diff, use_color=colored_stdout)
+                sys.stdout.flush()
+        except UnexpectedError as e:
+            print_trouble(prog, str(e), use_colors=colored_stderr)
+            sys.stderr.write(e.formatted_traceback)
+        if args.cache:
+            # rounds are few and far between, keep the bound as main() does
+            args.cache.evict()
+
+
+class RunCoalescer(object):
+    """Shares a single clang-format run between the concurrent checks of
+    identical inputs, for --serve.
+
+    Runs are identical when they pass the same contents on stdin, with the
+    same arguments, for files of the same type under the same style.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [done event, (outs, errs), DiffError]
+        self.pending = {}
+
+    @staticmethod
+    def key(invocation, input, styles):
+        if input is None or not invocation[-1].startswith(
+                '--assume-filename='):
+            return None
+        file = invocation[-1][len('--assume-filename='):]
+        h = hashlib.sha1(input)
+        for arg in invocation[:-1]:
+            h.update(b'\0' + arg.encode('utf-8'))
+        h.update(b'\0' + styles.hash(file).encode('utf-8'))
+        h.update(b'\0' + os.path.splitext(file)[1].encode('utf-8'))
+        return h.hexdigest()
+
+    def run(self, styles, invocation, input=None, timings=None):
+        """Same as run_clang_format(), styles is the StyleResolver of the
+        check."""
+        key = self.key(invocation, input, styles)
+        if key is None:
+            return run_clang_format(invocation, input, timings)
+        with self.lock:
+            pending = self.pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.pending[key] = [threading.Event(), None, None]
+        if owner:
+            try:
+                pending[1] = run_clang_format(invocation, input, timings)
+            except DiffError as e:
+                pending[2] = e
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                pending[0].set()
+        else:
+            start = time.time()
+            pending[0].wait()
+            if timings is not None:
+                timings['spawn'] = 0.0
+                add_timing(timings, 'format', start)
+        if pending[2] is not None:
+            raise pending[2]
+        return pending[1]
+
+
+def serve(prog, args, exclude, njobs):
+    """main() of --serve: answers validate and fix requests on a unix
+    socket until interrupted.
+
+    Every request is a line of JSON, {"command": "validate" or "fix",
+    "files": [...], "cwd": ..., "recursive": ..., "rescan": ...}, answered
+    by a line of JSON with the exit code and the report entries of the
+    files. Without files, the files found under the roots the server was
+    started with are validated: an index kept current by watching them,
+    or listed again with "rescan".
+    """
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        print_trouble(prog, 'unix sockets are not supported here',
+                      use_colors=False)
+        return ExitStatus.TROUBLE
+    coalescer = RunCoalescer()
+    executor = ThreadPoolExecutor(njobs)
+    # real path -> file as listed, of the files under the roots
+    index = {}
+    index_lock = threading.Lock()
+    # time.time() of the last result cache eviction, evicting after every
+    # request would list the whole cache every time
+    evicted = [time.time()]
+    evict_lock = threading.Lock()
+
+    def evict():
+        with evict_lock:
+            if time.time() - evicted[0] < EVICT_INTERVAL:
+                return
+            evicted[0] = time.time()
+        args.cache.evict()
+
+    def list_index():
+        index.clear()
+        for file in list_files(args.files,
+                               recursive=args.recursive,
+                               exclude=exclude,
+                               extensions=args.extensions.split(',')):
+            index[os.path.realpath(file)] = file
+
+    def follow_changes(watcher):
+        """Keeps the index in step with the files created and deleted under
+        the roots, in the background."""
+        while True:
+            try:
+                changed = watcher.wait()
+            except OSError as e:
+                sys.stderr.write(
+                    '{}: falling back to polling: {}\n'.format(prog, e))
+                watcher.close()
+                watcher = PollingWatcher(args, exclude, 1.0)
+                changed = None
+            with index_lock:
+                if changed is None or getattr(watcher, 'overflowed', False):
+                    # the events are incomplete
+                    watcher.overflowed = False
+                    list_index()
+                    continue
+                for path in changed:
+                    if not os.path.isfile(path):
+                        index.pop(path, None)
+                for file in select_paths(sorted(changed), args.files,
+                                         args.recursive,
+                                         args.extensions.split(','),
+                                         exclude):
+                    if os.path.isfile(file):
+                        index[os.path.realpath(file)] = file
+
+    list_index()
+    threading.Thread(target=follow_changes,
+                     args=(make_watcher(prog, args, exclude),),
+                     daemon=True).start()
+
+    def check(request):
+        if request.get('command') not in ('validate', 'fix'):
+            raise ValueError('unknown command: {!r}'.format(
+                request.get('command')))
+        request_args = argparse.Namespace(**vars(args))
+        request_args.fix = request['command'] == 'fix'
+        # the style files may have changed since the previous request
+        request_args.styles = StyleResolver()
+        if request.get('files'):
+            cwd = request.get('cwd') or os.getcwd()
+            files = list_files(
+                [os.path.join(cwd, file) for file in request['files']],
+                recursive=request.get('recursive', args.recursive),
+                exclude=exclude,
+                extensions=args.extensions.split(','))
+        else:
+            with index_lock:
+                if request.get('rescan'):
+                    list_index()
+                files = list(index.values())
+            # deleted before the watcher caught up
+            files = [file for file in files if os.path.isfile(file)]
+        if request_args.fix:
+            files = unique_real_paths(files)
+        futures = [
+            executor.submit(run_clang_format_diff_batch, request_args,
+                            [file], partial(coalescer.run,
+                                            request_args.styles))
+            for file in files
+        ]
+        retcode = ExitStatus.SUCCESS
+        entries = []
+        for future in futures:
+            for result in future.result():
+                entries.append(report_entry(result))
+                if result.error:
+                    retcode = ExitStatus.TROUBLE
+                elif (result.diff and not result.fixed
+                      and retcode == ExitStatus.SUCCESS):
+                    retcode = ExitStatus.DIFF
+        if args.cache:
+            evict()
+        return {'exit_code': retcode, 'files': entries}
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    response = check(json.loads(line.decode('utf-8')))
+                except Exception as e:
+                    response = {
+                        'exit_code': ExitStatus.TROUBLE,
+                        'error': '{}: {}'.format(e.__class__.__name__, e),
+                        'files': [],
+                    }
+                self.wfile.write(json.dumps(response).encode('utf-8') +
+                                 b'\n')
+                self.wfile.flush()
+
+    if os.path.exists(args.serve):
+        # left behind by a server that did not shut down cleanly,
+        # refuse to take over a live one
+        try:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            probe.connect(args.serve)
+        except OSError:
+            os.remove(args.serve)
+        else:
+            probe.close()
+            print_trouble(prog, '{} is in use'.format(args.serve),
+                          use_colors=False)
+            return ExitStatus.TROUBLE
+    server = socketserver.ThreadingUnixStreamServer(args.serve, Handler)
+    server.daemon_threads = True
+    # clean up the socket on kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stderr.write('serving on {}, {} files indexed\n'.format(
+        args.serve, len(index)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.serve)
+        executor.shutdown()
+        if args.cache:
+            args.cache.evict()
+    return ExitStatus.SUCCESS
+
+
+def connect_main(prog, args, colored_stdout, colored_stderr):
+    """main() of --connect: has a --serve server check the files."""
+    request = {
+        'command': 'fix' if args.fix else 'validate',
+        'files': args.files,
+        'cwd': os.getcwd(),
+        'recursive': args.recursive,
+        'rescan': args.rescan,
+    }
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(args.connect)
+        with client.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            response = json.loads(f.readline().decode('utf-8'))
+        client.close()
+    except (OSError, ValueError) as e:
+        print_trouble(prog,
+                      'could not reach {}: {}'.format(args.connect, e),
+                      use_colors=colored_stderr)
+        return ExitStatus.TROUBLE
+    if 'error' in response:
+        print_trouble(prog, response['error'], use_colors=colored_stderr)
+    entries = response['files']
+    print_entries(prog, args, entries, colored_stdout, colored_stderr)
+    return print_summary(args, response['exit_code'], len(entries),
+                         count_fixed(entries))
+
+
+def print_entries(prog, args, entries, colored_stdout, colored_stderr):
+    """Prints the errors and diffs of report entries."""
+    for entry in entries:
+        if entry['verdict'] == 'error':
+            print_trouble(prog, entry['error'], use_colors=colored_stderr)
+        elif args.quiet:
+            continue
+        elif entry['verdict'] == 'diff':
+            print_diff(entry['diff'].splitlines(True),
+                       use_color=colored_stdout)
+        elif entry['verdict'] == 'fixed':
+            sys.stdout.write('reformatted {}\n'.format(entry['file']))
+
+
+def run_summary(args, retcode, duration):
+    """The summary of a --report-file."""
+    summary = {
+        'clang_format_version': args.clang_format_version,
+        'exit_code': retcode,
+        'duration': duration,
+    }
+    if args.shard:
+        summary['shard'] = '{}/{}'.format(*args.shard)
+    return summary
+
+
+def write_report(prog, args, entries, summary, retcode, colored_stderr):
+    """Writes --report-file, returns retcode, or ExitStatus.TROUBLE if the
+    report could not be written."""
+    try:
+        write_file_atomic(
+            args.report_file,
+            REPORT_FORMATS[args.report_format](entries, summary))
+    except EnvironmentError as e:
+        print_trouble(prog,
+                      'could not write the report: {}'.format(e),
+                      use_colors=colored_stderr)
+        return ExitStatus.TROUBLE
+    return retcode
+
+
+def count_fixed(entries):
+    return sum(entry['verdict'] == 'fixed' for entry in entries)
+
+
+def print_summary(args, retcode, nfiles, fixed):
+    if args.fix and retcode == ExitStatus.SUCCESS:
+        sys.stdout.write("clang-format fixed " + str(fixed) + " of " +
+                         str(nfiles) + " files\n")
+    elif retcode == ExitStatus.SUCCESS:
+        sys.stdout.write(
+            "clang-format validation passed: no issues found in " +
+            str(nfiles) + " files\n")
+    else:
+        sys.stderr.write("clang-format validation failed\n")
+    return retcode
+
+
+def merge_main(prog, args, colored_stdout, colored_stderr):
+    """main() of --merge-reports."""
+    try:
+        entries, summary = merge_reports(args.merge_reports)
+    except ValueError as e:
+        print_trouble(prog, str(e), use_colors=colored_stderr)
+        return ExitStatus.TROUBLE
+
+    print_entries(prog, args, entries, colored_stdout, colored_stderr)
+    retcode = summary['exit_code']
+
+    if args.report_file:
+        retcode = write_report(prog, args, entries, summary, retcode,
+                               colored_stderr)
+    return print_summary(args, retcode, len(entries), count_fixed(entries))
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         '--clang-format-executable',
         metavar='EXECUTABLE',
-        help='path to the clang-format executable',
-        default='clang-format')
+        help='path to the clang-format executable (default: the bundled'
+        ' one, or a clang-format from PATH if it cannot run)')
     parser.add_argument(
         '--extensions',
         help='comma separated list of file extensions (default: {})'.format(
@@ -250,7 +2990,7 @@ def main():
         '--recursive',
         action='store_true',
         help='run recursively over directories')
-    parser.add_argument('files', metavar='file', nargs='+')
+    parser.add_argument('files', metavar='file', nargs='*')
     parser.add_argument(
         '-q',
         '--quiet',
@@ -261,8 +3001,31 @@ def main():
         metavar='N',
         type=int,
         default=0,
-        help='run N clang-format jobs in parallel'
-        ' (default number of cpus + 1)')
+        help='run N clang-format jobs in parallel (default: number of'
+        ' cpus + 1, within the cpu affinity, cgroup CPU quota and cgroup'
+        ' memory limit of the process)')
+    parser.add_argument(
+        '--tune-jobs',
+        action='store_true',
+        help='without -j, pick the number of jobs from the throughput of'
+        ' the previous runs on this host, trying more or fewer jobs than'
+        ' the fastest so far until neither improves it')
+    parser.add_argument(
+        '--backend',
+        default='thread',
+        choices=sorted(BACKENDS),
+        help='how to run the clang-format jobs in parallel: from a thread'
+        ' pool, from an asyncio event loop, or from a pool of Python worker'
+        ' processes (default: thread)')
+    parser.add_argument(
+        '--schedule',
+        default='largest',
+        choices=SCHEDULES,
+        help='order in which files are handed to the jobs: as listed,'
+        ' largest first, most recently modified first, or slowest first'
+        ' according to previous runs, which only the runs with this'
+        ' schedule or --shard-by cost record, in --cache-dir'
+        ' (default: largest)')
     parser.add_argument(
         '--color',
         default='auto',
@@ -276,8 +3039,186 @@ def main():
         default=[],
         help='exclude paths matching the given glob-like pattern(s)'
         ' from recursive search')
+    parser.add_argument(
+        '--fix',
+        action='store_true',
+        help='reformat the files that are not formatted correctly in place'
+        ' instead of printing their diff, the other files are left'
+        ' untouched')
+    parser.add_argument(
+        '--batch-size',
+        metavar='N',
+        type=int,
+        default=1,
+        help='check N files per clang-format process, 0 picks the size'
+        ' from the number of files and jobs (default: 1)')
+    parser.add_argument(
+        '--replacements',
+        action='store_true',
+        help='have clang-format report replacement offsets instead of the'
+        ' reformatted files and diff only around them, always the case'
+        ' for batches of several files')
+    parser.add_argument(
+        '--mmap',
+        action='store_true',
+        help='map the files into memory instead of copying them, the files'
+        ' must not be truncated while the validation runs')
+    parser.add_argument(
+        '--since',
+        metavar='REF',
+        help='only validate files that changed relative to the given git'
+        ' commit, e.g. $(git merge-base origin/master HEAD)')
+    parser.add_argument(
+        '--staged',
+        action='store_true',
+        help='only validate files with changes staged in the git index')
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help='validate the contents staged in the git index rather than'
+        ' the working tree files, of the files with staged changes; for'
+        ' pre-commit hooks, where files may be partially staged')
+    parser.add_argument(
+        '--changed-lines',
+        action='store_true',
+        help='with --since or --staged, only check the lines touched by'
+        ' the change instead of whole files')
+    parser.add_argument(
+        '--shard',
+        metavar='INDEX/COUNT',
+        type=parse_shard,
+        help='only validate the INDEX-th of COUNT parts of the files, for'
+        ' spreading a run over several machines; see --merge-reports')
+    parser.add_argument(
+        '--shard-by',
+        default='hash',
+        choices=('hash', 'cost'),
+        help='how --shard splits the files: by a hash of their path, or'
+        ' balanced by their duration in previous runs (by size if never'
+        ' checked), which requires every shard to use the same --cache-dir'
+        ' contents (default: hash)')
+    parser.add_argument(
+        '--merge-reports',
+        metavar='REPORT',
+        nargs='+',
+        help='instead of validating files, combine the JSON reports of'
+        ' the shards of a run into one verdict and exit code, and into'
+        ' --report-file if given')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='after validating the files, keep watching them and validate'
+        ' again the ones that change, with inotify where available')
+    parser.add_argument(
+        '--watch-interval',
+        metavar='SECONDS',
+        type=float,
+        help='with --watch, poll for changes every SECONDS instead of'
+        ' using inotify')
+    parser.add_argument(
+        '--watch-debounce',
+        metavar='SECONDS',
+        type=float,
+        default=0.2,
+        help='with --watch, wait for SECONDS without changes before'
+        ' validating, so that a burst of saves is validated once'
+        ' (default: 0.2)')
+    parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        help='run as a server answering validate and fix requests on the'
+        ' unix socket SOCKET, keeping the clang-format version, the files'
+        ' under the given roots and the result cache at hand; identical'
+        ' contents requested at the same time are formatted once')
+    parser.add_argument(
+        '--connect',
+        metavar='SOCKET',
+        help='have the --serve server on SOCKET check the files, or all the'
+        ' files it indexed if none are given')
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        help='with --connect, have the server list the files under its roots'
+        ' again first, instead of relying on the changes it watches')
+    parser.add_argument(
+        '--max-errors',
+        metavar='N',
+        type=int,
+        default=0,
+        help='stop after N files with a diff or an error, killing the'
+        ' clang-format processes still running (default: 0, no limit)')
+    parser.add_argument(
+        '--fail-fast',
+        action='store_const',
+        dest='max_errors',
+        const=1,
+        help='stop at the first file with a diff or an error,'
+        ' same as --max-errors 1')
+    parser.add_argument(
+        '--report-file',
+        metavar='PATH',
+        help='also write a report with the verdict, the number of changed'
+        ' hunks and lines, the clang-format time and the bytes read for'
+        ' every file to PATH')
+    parser.add_argument(
+        '--report-format',
+        default='json',
+        choices=sorted(REPORT_FORMATS),
+        help='format of the --report-file (default: json)')
+    parser.add_argument(
+        '--profile',
+        metavar='N',
+        type=int,
+        nargs='?',
+        const=10,
+        help='print the time spent per stage, the worker utilization and'
+        ' the N slowest files (default: 10) to stderr')
+    parser.add_argument(
+        '--trace-file',
+        metavar='PATH',
+        help='write a timeline of the run with a track per job and a span'
+        ' per file to PATH, in the Chrome trace event format')
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        default=default_cache_dir(),
+        help='directory of the result cache that lets unchanged, correctly'
+        ' formatted files skip clang-format, and of the inventory that lets'
+        ' them skip being read when their size, inode and mtime did not'
+        ' change either (default: {})'.format(
+            default_cache_dir()))
+    parser.add_argument(
+        '--cache-size',
+        metavar='N',
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help='maximum number of cache entries, least recently used ones'
+        ' are evicted first (default: {})'.format(DEFAULT_CACHE_SIZE))
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='do not use the result cache, the file inventory, nor the'
+        ' cached clang-format path and version')
 
     args = parser.parse_args()
+    if args.index:
+        if args.fix:
+            parser.error('--fix cannot be combined with --index')
+        args.staged = True
+    if args.changed_lines and not (args.since or args.staged):
+        parser.error('--changed-lines requires --since or --staged')
+    if not args.files and not (args.merge_reports or args.serve
+                               or args.connect):
+        parser.error('the following arguments are required: file')
+    if (args.serve or args.connect) and (args.since or args.staged
+                                         or args.watch):
+        parser.error('--serve and --connect cannot be combined with'
+                     ' --since, --staged, --index or --watch')
+    if args.rescan and not args.connect:
+        parser.error('--rescan requires --connect')
+    if args.watch and (args.since or args.staged or args.merge_reports):
+        parser.error('--watch cannot be combined with --since, --staged,'
+                     ' --index or --merge-reports')
 
     # use default signal handling, like diff return SIGINT value on ^C
     # https://bugs.python.org/issue14229#msg156446
@@ -299,9 +3240,22 @@ def main():
         colored_stdout = sys.stdout.isatty()
         colored_stderr = sys.stderr.isatty()
 
+    if args.merge_reports:
+        return merge_main(parser.prog, args, colored_stdout, colored_stderr)
+    if args.connect:
+        return connect_main(parser.prog, args, colored_stdout,
+                            colored_stderr)
+
+    def warn(lines):
+        for line in lines:
+            sys.stderr.write('WARNING: ' + line + '\n')
+
     version_invocation = [args.clang_format_executable, str("--version")]
+    explicit_executable = args.clang_format_executable
     try:
-        subprocess.check_call(version_invocation, stdout=DEVNULL)
+        executable, args.clang_format_version = resolve_clang_format(
+            args.clang_format_executable,
+            None if args.no_cache else args.cache_dir, warn)
     except subprocess.CalledProcessError as e:
         print_trouble(parser.prog, str(e), use_colors=colored_stderr)
         return ExitStatus.TROUBLE
@@ -314,44 +3268,139 @@ def main():
             use_colors=colored_stderr,
         )
         return ExitStatus.TROUBLE
+    if executable is None:
+        warn(['skipping format validation as no suitable executable was'
+              ' found'])
+        return ExitStatus.SUCCESS
+    args.clang_format_executable = executable
+
+    args.cache = None
+    if not args.no_cache:
+        args.cache = ResultCache(args.cache_dir, args.cache_size)
 
     retcode = ExitStatus.SUCCESS
+    profile = Profile() if args.profile is not None else None
+    trace = Trace() if args.trace_file else None
 
     excludes = excludes_from_file(DEFAULT_CLANG_FORMAT_IGNORE)
     excludes.extend(args.exclude)
+    excludes = ExcludeMatcher(excludes)
+
+    args.line_ranges = None
+    args.styles = StyleResolver()
+    args.index_blobs = None
+    if args.serve:
+        return serve(parser.prog, args, excludes, args.j or default_jobs())
+    if args.since or args.staged:
+        try:
+            if args.changed_lines:
+                args.line_ranges = changed_line_ranges(since=args.since,
+                                                       staged=args.staged)
+            files = list_changed_files(
+                args.files,
+                since=args.since,
+                staged=args.staged,
+                recursive=args.recursive,
+                exclude=excludes,
+                extensions=args.extensions.split(','))
+        except (subprocess.CalledProcessError, OSError) as e:
+            print_trouble(parser.prog,
+                          "could not list changed files: {}".format(e),
+                          use_colors=colored_stderr)
+            return ExitStatus.TROUBLE
+        if args.index:
+            try:
+                args.index_blobs = read_index_blobs(files)
+            except (subprocess.CalledProcessError, OSError) as e:
+                print_trouble(parser.prog,
+                              "could not read the git index: {}".format(e),
+                              use_colors=colored_stderr)
+                return ExitStatus.TROUBLE
+    else:
+        files = list_files(
+            args.files,
+            recursive=args.recursive,
+            exclude=excludes,
+            extensions=args.extensions.split(','))
 
-    files = list_files(
-        args.files,
-        recursive=args.recursive,
-        exclude=excludes,
-        extensions=args.extensions.split(','))
+    if args.fix:
+        files = unique_real_paths(files)
+    if not files and not args.watch:
+        if args.report_file:
+            # an empty shard of a run still reports for --merge-reports
+            return write_report(
+                parser.prog, args, [],
+                run_summary(args, ExitStatus.SUCCESS, 0.0),
+                ExitStatus.SUCCESS, colored_stderr)
+        return ExitStatus.SUCCESS
+    if profile:
+        add_timing(profile.stages, 'discovery', profile.start)
 
-    if not files:
-        return
+    start_time = time.time()
+    entries = []
+    history = None
+    if args.schedule == 'history' or (args.shard and
+                                      args.shard_by == 'cost'):
+        history = DurationHistory(
+            None if args.no_cache else os.path.join(args.cache_dir,
+                                                    'history.json'),
+            args.cache_size)
+    if args.shard:
+        # a shard may end up empty, it still reports
+        files = shard_files(files, args.shard[0], args.shard[1],
+                            args.shard_by, history)
+    files = schedule_files(files, args.schedule, history)
+    inventory = None
+    # files to hand to the jobs, and files found unchanged by a stat
+    checked = files
+    unchanged = []
+    # a check of changed lines or of the staged contents tells nothing
+    # about the whole file in the work tree
+    if (args.cache and args.line_ranges is None
+            and args.index_blobs is None):
+        inventory = FileInventory(
+            os.path.join(args.cache_dir, 'inventory.json'),
+            args.clang_format_version, args.cache_size)
+        checked, unchanged = inventory.split(files, args.styles)
 
     njobs = args.j
+    tuner = None
     if njobs == 0:
-        njobs = multiprocessing.cpu_count() + 1
-    njobs = min(len(files), njobs)
+        njobs = default_jobs()
+        if args.tune_jobs:
+            tuner = JobTuner(os.path.join(args.cache_dir, 'jobs.json'))
+            njobs = tuner.choose(njobs)
+    batches = make_batches(checked, njobs, args.batch_size, args.styles)
+    if len(batches) < njobs:
+        # not enough work to measure the job count
+        tuner = None
+    njobs = max(1, min(len(batches), njobs))
 
+    fixed = 0
+    errors = 0
+    # real path -> stat_signature() of the files validated, for --watch
+    watched = {}
+    checked_files = 0
+    checked_bytes = 0
+    print_time = 0.0
+    # whether the first file clang-format ran for was seen
+    probed = False
     if njobs == 1:
-        # execute directly instead of in a pool,
-        # less overhead, simpler stacktraces
-        it = (run_clang_format_diff_wrapper(args, file) for file in files)
-        pool = None
+        it = iter_serial_results(args, batches, njobs)
     else:
-        pool = multiprocessing.Pool(njobs)
-        it = pool.imap_unordered(
-            partial(run_clang_format_diff_wrapper, args), files)
+        it = BACKENDS[args.backend](args, batches, njobs)
+    if unchanged:
+        results = []
+        for file in unchanged:
+            result = FileResult(file)
+            result.skip = 'cached'
+            results.append(result)
+        it = iter_prepended_results(results, it)
     while True:
         try:
-            outs, errs = next(it)
+            results = next(it)
         except StopIteration:
             break
-        except DiffError as e:
-            print_trouble(parser.prog, str(e), use_colors=colored_stderr)
-            retcode = ExitStatus.TROUBLE
-            sys.stderr.writelines(e.errs)
         except UnexpectedError as e:
             print_trouble(parser.prog, str(e), use_colors=colored_stderr)
             sys.stderr.write(e.formatted_traceback)
@@ -359,22 +3408,113 @@ def main():
             # stop at the first unexpected error,
             # something could be very wrong,
             # don't process all files unnecessarily
-            if pool:
-                pool.terminate()
+            it.close()
+            tuner = None
             break
-        else:
-            sys.stderr.writelines(errs)
-            if outs == []:
+        print_start = time.time()
+        for result in results:
+            if not probed and result.skip is None:
+                probed = True
+                if (result.error is not None and result.error.unusable
+                        and not explicit_executable and not args.no_cache):
+                    # the kept executable may no longer run, search again
+                    # and start over if that finds another one
+                    forget_clang_format(args.cache_dir)
+                    if resolve_clang_format(None, args.cache_dir, warn) != (
+                            executable, args.clang_format_version):
+                        it.close()
+                        return main()
+            if args.max_errors and errors >= args.max_errors:
+                break
+            if result.duration is not None:
+                if history:
+                    history.record(result.file, result.duration)
+                checked_files += 1
+                checked_bytes += result.bytes_read
+            # like the result cache, files with diagnostics are checked
+            # again to show them again
+            if (inventory and result.verdict in ('clean', 'cached')
+                    and not result.errs):
+                inventory.record(result.file)
+            if args.watch:
+                watched[os.path.realpath(result.file)] = stat_signature(
+                    result.file)
+            if profile:
+                profile.add(result)
+            if trace:
+                trace.add(result)
+            if args.report_file:
+                entries.append(report_entry(result))
+            if result.error:
+                print_trouble(parser.prog, str(result.error),
+                              use_colors=colored_stderr)
+                retcode = ExitStatus.TROUBLE
+                sys.stderr.writelines(result.error.errs)
+                errors += 1
+                continue
+            sys.stderr.writelines(result.errs)
+            if result.diff == []:
+                continue
+            if args.fix:
+                fixed += 1
+                if not args.quiet:
+                    sys.stdout.write('reformatted {}\n'.format(result.file))
                 continue
             if not args.quiet:
-                print_diff(outs, use_color=colored_stdout)
+                print_diff(result.diff, use_color=colored_stdout)
             if retcode == ExitStatus.SUCCESS:
                 retcode = ExitStatus.DIFF
+            errors += 1
+        print_time += time.time() - print_start
+        if trace:
+            trace.add_print(print_start, time.time())
+        if args.max_errors and errors >= args.max_errors:
+            sys.stderr.write(
+                'stopping after {} files with issues\n'.format(errors))
+            # closing the iterator cancels the remaining jobs
+            it.close()
+            tuner = None
+            break
 
-    if retcode == ExitStatus.SUCCESS:
-        sys.stdout.write("clang-format validation passed: no issues found in " + str(len(files)) + " files\n")
-    else:
-        sys.stderr.write("clang-format validation failed\n")
+    if tuner:
+        tuner.record(njobs, checked_files, checked_bytes,
+                     time.time() - start_time - print_time)
+    if profile:
+        profile.execution = time.time() - start_time - print_time
+        profile.stages['print'] = print_time
+
+    if args.cache:
+        args.cache.evict()
+    if inventory:
+        inventory.save()
+    if history:
+        history.save()
+
+    if trace:
+        try:
+            trace.write(args.trace_file)
+        except EnvironmentError as e:
+            print_trouble(parser.prog,
+                          'could not write the trace: {}'.format(e),
+                          use_colors=colored_stderr)
+            retcode = ExitStatus.TROUBLE
+
+    if args.report_file:
+        retcode = write_report(
+            parser.prog, args, entries,
+            run_summary(args, retcode, time.time() - start_time), retcode,
+            colored_stderr)
+
+    if profile:
+        profile.write(sys.stderr, njobs, 'serial' if njobs == 1 else
+                      args.backend, args.profile)
+
+    print_summary(args, retcode, len(files), fixed)
+
+    if args.watch:
+        sys.stdout.flush()
+        watch(parser.prog, args, excludes, args.j or default_jobs(),
+              watched, colored_stdout, colored_stderr)
 
     return retcode
 